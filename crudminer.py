@@ -21,11 +21,14 @@
 
 import os, sys
 import re
+import errno
 
 from ConfigParser import ConfigParser, RawConfigParser, NoOptionError
 from fnmatch      import fnmatch
+from collections  import OrderedDict
 
 import smtplib
+import socket
 
 try:
     import sqlite3 as sqlite
@@ -41,22 +44,382 @@ except ImportError:
     from email.Utils import COMMASPACE
 
 import time, datetime
+import threading
 
 
 VERSION   = '0.4.0'
-DBVERSION = 2
+DBVERSION = 5
+BUNDLEVERSION = 6
+RESULTSVERSION = 1
+SCANCACHEVERSION = 1
 CRUDFILE  = 'crud.ini'
+CRUDCACHE = '~/.cache/crudminer'
 MAILOPTS  = 'mailopts.ini'
 
 dotremove = re.compile('^\.$', re.MULTILINE)
 
-class CrudProduct:
+#: Used to split version strings into numeric and alphabetic segments
+versegments = re.compile('[0-9]+|[a-zA-Z]+')
+
+#: Flags of the product regexes in crud.ini
+REGEXFLAGS = re.MULTILINE | re.DOTALL
+#: pattern: compiled product regex, filled in as products need them, 
+#: so each process only compiles the regexes it uses
+_regexes = {}
+
+#: How long to use a downloaded crud.ini before checking for a new one
+CRUDTTL = 3600
+#: How soon to try again if we could not check for a new crud.ini
+CRUDRETRY = 300
+#: How long to wait for the server when downloading crud.ini
+CRUDTIMEOUT = 30
+
+#: How often to look for changes in --watch mode, in seconds
+WATCHINTERVAL = 5
+
+#: How big to make the files lint_signatures tries regexes on
+LINTSIZE = 1048576
+#: How long lint_signatures lets regexes without a budget run
+LINTBUDGET = 1.0
+
+#: How many parsed versions to keep around
+VERSIONCACHE = 4096
+
+class VersionKey(object):
+    """
+    Parsed version string, suitable for sorting, comparing and using as
+    a dict key. Versions are split into numeric and alphabetic segments,
+    ignoring everything else, e.g. '2xFg33.+f.5' => (2, 'xFg', 33, 'f', 5).
+    Segments are compared one by one: numbers as numbers, letters as 
+    strings, and a number is always greater than letters. If all the
+    segments are the same, the version with more segments is greater.
+    A VersionKey is never equal to anything that isn't one.
+
+    Adapted from a function found on
+    http://concisionandconcinnity.blogspot.com/
+    Snippet Copyright 2008 Ian McCracken, licensed under GPLv3.
+    """
+
+    __slots__ = ('version', 'segments')
+
+    def __init__(self, version):
+        """
+        @param version: the version string
+        @type  version: str
+        """
+        #: The original version string
+        self.version  = version
+        #: Tuple of (1, int) for numeric and (0, str) for other segments
+        segments = []
+        for segment in versegments.findall(version):
+            if segment.isdigit():
+                segments.append((1, int(segment)))
+            else:
+                segments.append((0, segment))
+        self.segments = tuple(segments)
+
+    def __repr__(self):
+        return 'VersionKey(%r)' % self.version
+
+    def __getstate__(self):
+        return (self.version, self.segments)
+
+    def __setstate__(self, state):
+        (self.version, self.segments) = state
+
+    def __hash__(self):
+        return hash(self.segments)
+
+    def __eq__(self, other):
+        if not isinstance(other, VersionKey):
+            return NotImplemented
+        return self.segments == other.segments
+
+    def __ne__(self, other):
+        if not isinstance(other, VersionKey):
+            return NotImplemented
+        return self.segments != other.segments
+
+    def __lt__(self, other):
+        if not isinstance(other, VersionKey):
+            return NotImplemented
+        return self.segments < other.segments
+
+    def __le__(self, other):
+        if not isinstance(other, VersionKey):
+            return NotImplemented
+        return self.segments <= other.segments
+
+    def __gt__(self, other):
+        if not isinstance(other, VersionKey):
+            return NotImplemented
+        return self.segments > other.segments
+
+    def __ge__(self, other):
+        if not isinstance(other, VersionKey):
+            return NotImplemented
+        return self.segments >= other.segments
+
+    def __cmp__(self, other):
+        if not isinstance(other, VersionKey):
+            return NotImplemented
+        return cmp(self.segments, other.segments)
+
+_versioncache = OrderedDict()
+_versionlock  = threading.Lock()
+
+def parse_version(version):
+    """
+    Get the VersionKey for a version string. Recently parsed versions 
+    are kept in a small LRU cache, since we see the same ones a lot.
+
+    @param version: the version string
+    @type  version: str
+
+    @rtype: VersionKey
+    """
+    _versionlock.acquire()
+    try:
+        try:
+            key = _versioncache.pop(version)
+        except KeyError:
+            key = VersionKey(version)
+            if len(_versioncache) >= VERSIONCACHE:
+                _versioncache.popitem(last=False)
+        _versioncache[version] = key
+    finally:
+        _versionlock.release()
+
+    return key
+
+class AtomicFile:
+    """
+    A file that is written under a temporary name next to where it
+    goes, and renamed into place when it is closed, so nobody ever 
+    reads a half-written one.
+    """
+
+    def __init__(self, path, mode='w'):
+        """
+        @param path: where the file goes
+        @type  path: str
+        @param mode: the mode to open it with (see open())
+        @type  mode: str
+        """
+        #: where the file goes once it's closed
+        self.path    = path
+        #: where it is written until then
+        self.tmpfile = '%s.%d.tmp' % (path, os.getpid())
+
+        self._fh = open(self.tmpfile, mode)
+
+    def write(self, data):
+        """
+        @rtype: void
+        """
+        self._fh.write(data)
+
+    def close(self):
+        """
+        Put the file in place.
+
+        @rtype: void
+        """
+        self._fh.close()
+        os.rename(self.tmpfile, self.path)
+
+class Stats:
+    """
+    Counters and timings of what crudminer spends its time on: how much
+    it walked, matched and read, how long each phase took, and how many
+    times each product's regex ran and for how long, to find the
+    expensive crud.ini signatures.
+
+    Collecting them costs time too, so nothing is collected unless
+    "enabled" is set. Safe to use from several threads. Analysis pool
+    processes collect their own, which are merged into the parent's.
+    """
+
+    def __init__(self):
+        #: whether to collect anything
+        self.enabled  = False
+        #: name: how many
+        self.counters = {}
+        #: phase: seconds
+        self.timers   = {}
+        #: product name: [regex evaluations, seconds]
+        self.products = {}
+
+        self._lock = threading.Lock()
+
+    def count(self, name, amount=1):
+        """
+        Add to a counter.
+
+        @rtype: void
+        """
+        self._lock.acquire()
+        self.counters[name] = self.counters.get(name, 0) + amount
+        self._lock.release()
+
+    def time(self, phase, started):
+        """
+        Add the time since "started" (a time.time()) to the phase.
+
+        @rtype: void
+        """
+        elapsed = time.time() - started
+        self._lock.acquire()
+        self.timers[phase] = self.timers.get(phase, 0) + elapsed
+        self._lock.release()
+
+    def regex(self, product_name, started):
+        """
+        Record one run of a product's regex that began at "started".
+
+        @rtype: void
+        """
+        elapsed = time.time() - started
+        self._lock.acquire()
+        entry = self.products.setdefault(product_name, [0, 0])
+        entry[0] += 1
+        entry[1] += elapsed
+        self._lock.release()
+
+    def snapshot(self):
+        """
+        @return: copy of everything collected so far, that can be passed
+                 to merge() or dumped as JSON
+        @rtype: dict
+        """
+        self._lock.acquire()
+        snapshot = {
+                'counters': dict(self.counters),
+                'timers':   dict(self.timers),
+                'products': dict([(name, list(entry)) for (name, entry) 
+                                  in self.products.items()]),
+                }
+        self._lock.release()
+
+        return snapshot
+
+    def merge(self, snapshot):
+        """
+        Add everything from a snapshot (e.g. from a pool process).
+
+        @rtype: void
+        """
+        self._lock.acquire()
+        for (name, amount) in snapshot['counters'].items():
+            self.counters[name] = self.counters.get(name, 0) + amount
+        for (phase, elapsed) in snapshot['timers'].items():
+            self.timers[phase] = self.timers.get(phase, 0) + elapsed
+        for (name, (evaluations, elapsed)) in snapshot['products'].items():
+            entry = self.products.setdefault(name, [0, 0])
+            entry[0] += evaluations
+            entry[1] += elapsed
+        self._lock.release()
+
+    def reset(self):
+        """
+        Forget everything collected so far.
+
+        @rtype: void
+        """
+        self._lock.acquire()
+        self.counters = {}
+        self.timers   = {}
+        self.products = {}
+        self._lock.release()
+
+    def write_json(self, statsfile):
+        """
+        Save everything collected so far as JSON ("-" for stdout).
+
+        @rtype: void
+        """
+        import json
+
+        snapshot = self.snapshot()
+        products = {}
+        for (name, (evaluations, elapsed)) in snapshot['products'].items():
+            products[name] = {'evaluations': evaluations, 'seconds': elapsed}
+        snapshot['products'] = products
+
+        output = json.dumps(snapshot, indent=2, sort_keys=True) + '\n'
+        if statsfile == '-':
+            sys.stdout.write(output)
+        else:
+            fh = AtomicFile(statsfile)
+            fh.write(output)
+            fh.close()
+
+    def write_prometheus(self, promfile):
+        """
+        Save everything collected so far in the Prometheus text format,
+        e.g. for the node exporter's textfile collector.
+
+        @rtype: void
+        """
+        def label(value):
+            value = value.replace('\\', '\\\\').replace('"', '\\"')
+            return value.replace('\n', '\\n')
+
+        snapshot = self.snapshot()
+        lines = []
+
+        # these are all for one run, so they are all gauges
+        for (name, amount) in sorted(snapshot['counters'].items()):
+            metric = 'crudminer_%s' % name
+            lines.append('# TYPE %s gauge' % metric)
+            lines.append('%s %s' % (metric, amount))
+
+        lines.append('# TYPE crudminer_phase_seconds gauge')
+        for (phase, elapsed) in sorted(snapshot['timers'].items()):
+            lines.append('crudminer_phase_seconds{phase="%s"} %f' % (
+                         label(phase), elapsed))
+
+        products = sorted(snapshot['products'].items())
+        lines.append('# TYPE crudminer_regex_evaluations gauge')
+        for (name, (evaluations, elapsed)) in products:
+            lines.append('crudminer_regex_evaluations{product="%s"} %d' % (
+                         label(name), evaluations))
+        lines.append('# TYPE crudminer_regex_seconds gauge')
+        for (name, (evaluations, elapsed)) in products:
+            lines.append('crudminer_regex_seconds{product="%s"} %f' % (
+                         label(name), elapsed))
+
+        # the collector must never read half of it
+        fh = AtomicFile(promfile)
+        fh.write('\n'.join(lines) + '\n')
+        fh.close()
+
+#: What this process spent its time on (see Stats)
+stats = Stats()
+
+class CrudProduct(object):
     """
     Class to hold information about every product we're checking for.
     Basically, it takes information from crud.ini and provides a couple
     of methods to make comparions more convenient.
+
+    Products are sent to worker processes and saved in bundles, so they
+    only hold plain values and pickle as a tuple. The regex is compiled
+    when it is first used, once per process (see _regexes), and whether
+    it needs guarding is only known to the process that ran it.
     """
 
+    __slots__ = ('name', 'expand', 'secure', 'secure_key', 'comment', 
+                 'env', 'infourl', 'andpath', 'prune', 'maxbytes', 
+                 'minsize', 'maxsize', 'sniffbytes', 'budget', 'guarded',
+                 'timed', 'pattern', 'literal', 'anchored', '_regex')
+
+    #: What goes into a pickle: everything but the per-process state
+    _pickled = ('name', 'expand', 'secure', 'secure_key', 'comment', 
+                'env', 'infourl', 'andpath', 'prune', 'maxbytes', 
+                'minsize', 'maxsize', 'sniffbytes', 'budget', 'pattern', 
+                'literal', 'anchored')
+
     def __init__(self, name, config):
         """
         @param   name: the name of the product
@@ -68,6 +431,10 @@ class CrudProduct:
         self.expand  = config.get(name, 'expand')
         #: The secure version of the product
         self.secure  = config.get(name, 'secure')
+        #: Parsed secure version, or None if there isn't one
+        self.secure_key = None
+        if self.secure != 'none':
+            self.secure_key = parse_version(self.secure)
         #: Some comments about the product, if any
         self.comment = config.get(name, 'comment')
         #: The language environment of the product (e.g. "php")
@@ -85,37 +452,95 @@ class CrudProduct:
             # assume we have an older crud.ini without andpath=
             pass
 
-        regex = config.get(name, 'regex')
-        #: Compiled regex to get the version out of a file
-        self.regex   = re.compile(regex, re.MULTILINE | re.DOTALL)
+        #: subdirs of the install root not worth walking into
+        self.prune = []
+
+        try:
+            prune = config.get(name, 'prune')
+            if prune != '':
+                self.prune = comma2array(prune)
+        except NoOptionError:
+            # older crud.ini without prune=
+            pass
+
+        #: how many bytes at the start of the file to look at (0: all)
+        self.maxbytes = 0
+
+        try:
+            self.maxbytes = config.getint(name, 'maxbytes')
+        except NoOptionError:
+            # older crud.ini without maxbytes=
+            pass
+
+        #: the smallest file (in bytes) the product can be in
+        self.minsize = 0
+        #: the largest file (in bytes) the product can be in (0: no limit)
+        self.maxsize = 0
+        #: how many bytes at the start of the file the literal must be
+        #: in, checked before reading any further (0: don't check)
+        self.sniffbytes = 0
+
+        for option in ('minsize', 'maxsize', 'sniffbytes'):
+            try:
+                setattr(self, option, config.getint(name, option))
+            except NoOptionError:
+                # older crud.ini without them
+                pass
+
+        #: how many seconds the regex may take on one file (0: no limit)
+        self.budget = 0
 
-        #: Used internally to identify alpha-numeric strings
-        self.isalnum = re.compile('[^a-zA-Z0-9]')
+        try:
+            self.budget = config.getfloat(name, 'budget')
+        except NoOptionError:
+            # older crud.ini without budget=
+            pass
 
-    def _gen_segments(self, val):
+        #: whether the regex went over budget, and now only runs in a
+        #: separate process that we can stop (see guarded_search)
+        self.guarded = False
+        #: whether the regex already finished within budget once in this
+        #: process; until it has, it is guarded as well
+        self.timed   = False
+
+        #: The regex to get the version out of a file
+        self.pattern = config.get(name, 'regex')
+        #: A string that must be in the file for the regex to match
+        self.literal = required_literal(self.pattern, REGEXFLAGS)
+        #: Whether the regex starts with ".*" (see search)
+        self.anchored = starts_with_anything(self.pattern, REGEXFLAGS)
+        #: The compiled regex, once we needed it (see regex)
+        self._regex = None
+
+    def __getstate__(self):
+        return tuple([getattr(self, slot) for slot in self._pickled])
+
+    def __setstate__(self, state):
+        for (slot, value) in zip(self._pickled, state):
+            setattr(self, slot, value)
+        self.guarded = False
+        self.timed   = False
+        self._regex  = None
+
+    def regex(self):
         """
-        Generator that splits a string into segments.
-        e.g., '2xFg33.+f.5' => ('2', 'xFg', '33', 'f', '5')
+        The compiled regex, compiled the first time any product in this
+        process needs it.
 
-        Adapted from a function found on
-        http://concisionandconcinnity.blogspot.com/
-        Snippet Copyright 2008 Ian McCracken, licensed under GPLv3.
+        @rtype: re.RegexObject
         """
-        val = self.isalnum.split(val)
-        for dot in val:
-            res = ''
-            for s in dot:
-                if not res:
-                    res += s
-                elif (res.isdigit() and s.isdigit()) or \
-                   (res.isalpha() and s.isalpha()):
-                    res += s
-                else:
-                    if res:
-                        yield res
-                    res = s
-            if res:
-                yield res
+        if self._regex is None:
+            regex = _regexes.get(self.pattern)
+            if regex is None:
+                regex = re.compile(self.pattern, REGEXFLAGS)
+                _regexes[self.pattern] = regex
+                if stats.enabled:
+                    stats.count('regex_compiles')
+            self._regex = regex
+
+        return self._regex
+
+    regex = property(regex)
 
     def version_compare(self, ver1, ver2):
         """
@@ -124,47 +549,32 @@ class CrudProduct:
             ver1 == ver2: return  0
             ver1  > ver2: return  1
 
-        Adapted from a function found on
-        http://concisionandconcinnity.blogspot.com/
-        Snippet Copyright 2008 Ian McCracken, licensed under GPLv3.
+        See VersionKey for how versions are compared.
         """
 
         # If they're the same, we're done
         if ver1 == ver2: return 0
 
-        l1, l2 = map(self._gen_segments, (ver1, ver2))
-        while l1 and l2:
-            # Get the next segment; if none exists, done
-            try: s1 = l1.next()
-            except StopIteration: s1 = None
-            try: s2 = l2.next()
-            except StopIteration: s2 = None
-
-            if s1 is None and s2 is None: break
-            if (s1 and not s2): return 1
-            if (s2 and not s1): return -1
-
-            # Check for type mismatch
-            if s1.isdigit() and not s2.isdigit(): return 1
-            if s2.isdigit() and not s1.isdigit(): return -1
-
-            # Cast as ints if possible
-            if s1.isdigit(): s1 = int(s1)
-            if s2.isdigit(): s2 = int(s2)
-
-            rc = cmp(s1, s2)
-            if rc: return rc
+        if stats.enabled:
+            started = time.time()
+            result = cmp(parse_version(ver1), parse_version(ver2))
+            stats.count('version_compares')
+            stats.time('version_compare', started)
+            return result
 
-        return 0
+        return cmp(parse_version(ver1), parse_version(ver2))
 
-    def analyze(self, installdir, contents):
+    def analyze(self, installdir, contents, literals=None):
         """
         Try to find the product version in the file contents.
 
-        @param installdir: the directory that matched (for andpath checking)
+        @param installdir: the directory that matched
         @type  installdir: str
         @param contents: the contents of a file
-        @type  contents: str
+        @type  contents: str or mmap
+        @param literals: dict to remember which literals are in contents,
+                         shared between products looking at the same file
+        @type  literals: dict
 
         @return: (is_secure, got_version)
                     is_secure:   boolean True if the version is secure
@@ -172,178 +582,2875 @@ class CrudProduct:
         @rtype: tuple
         """
 
-        if self.andpath:
-            # look for other files relative to this dir to verify
-            # that it's not some other product with similar files
-            for checkpath in self.andpath:
-                fullpath = os.path.normpath(installdir + checkpath)
-                if not os.access(fullpath, os.R_OK):
-                    return None
+        if not self.has_literal(contents, literals):
+            # no point running the regex at all
+            if stats.enabled:
+                stats.count('literal_skips')
+            return None
+
+        started = time.time()
+
+        if self.guarded or (self.budget and not self.timed):
+            # we know nothing about how long this regex takes yet, or
+            # know that it can take too long
+            (finished, got_version) = guarded_search(self, contents, 
+                                                     self.budget)
+            if stats.enabled:
+                stats.regex(self.name, started)
+            if not finished:
+                self.guarded = True
+                if stats.enabled:
+                    stats.count('regex_timeouts')
+                print >> sys.stderr, '[%s] regex took longer than %s ' \
+                      'seconds in %s, skipped' % (self.name, self.budget, 
+                                                  installdir)
+                return None
+            self.timed = True
+            if got_version is None:
+                return None
+
+            return (self.is_secure(got_version), got_version)
+
+        match = self.search(contents)
+
+        if stats.enabled:
+            stats.regex(self.name, started)
+
+        if self.budget and time.time() - started > self.budget:
+            # we can't stop a regex once it started, so make sure we can 
+            # next time
+            self.guarded = True
+            print >> sys.stderr, '[%s] regex took %.1f seconds in %s, ' \
+                  'over its budget of %s' % (self.name, 
+                        time.time() - started, installdir, self.budget)
 
-        match = self.regex.search(contents)
         if match is None:
             return None
 
         got_version = match.expand(self.expand)
-        is_secure = False
 
-        if self.secure != 'none' and \
-                self.version_compare(got_version, self.secure) >= 0:
-            is_secure = True
+        return (self.is_secure(got_version), got_version)
+
+    def search(self, contents):
+        """
+        Run the regex against the part of the contents it looks at.
+
+        A regex starting with ".*" matches from the start of the contents
+        whenever it matches anywhere, and finds the same match from there,
+        so for those we only try at the start, instead of trying at every
+        position like re.search does. On a file without a match, that is
+        the difference between linear and quadratic time.
+
+        @param contents: the contents of a file
+        @type  contents: str or mmap
+
+        @return: the match, or None
+        @rtype: re.MatchObject
+        """
+        endpos = self.maxbytes or len(contents)
+        if self.anchored:
+            return self.regex.match(contents, 0, endpos)
+
+        return self.regex.search(contents, 0, endpos)
+
+    def has_literal(self, contents, literals=None):
+        """
+        Cheap check whether the literal part of our regex is present in
+        the part of the contents that the regex will look at.
+
+        @param contents: the contents of a file
+        @type  contents: str or mmap
+        @param literals: dict to remember the results in, if any
+        @type  literals: dict
+
+        @rtype: boolean
+        """
+        if self.literal is None:
+            return True
+
+        key = (self.literal, self.maxbytes)
+        if literals is not None and key in literals:
+            return literals[key]
+
+        if self.maxbytes:
+            found = contents.find(self.literal, 0, self.maxbytes) != -1
+        else:
+            found = contents.find(self.literal) != -1
+
+        if literals is not None:
+            literals[key] = found
+
+        return found
+
+    def fits_size(self, size):
+        """
+        Check whether a file of this size can have the product in it.
+
+        @param size: the size of the file in bytes
+        @type  size: int
+
+        @rtype: boolean
+        """
+        if size < self.minsize:
+            return False
+        if self.maxsize and size > self.maxsize:
+            return False
+
+        return True
+
+    def in_sniff(self, head):
+        """
+        Check whether the literal part of our regex is where we expect
+        it, at the start of the file (see sniffbytes). If we don't know
+        where it should be, or there is no literal, it could be anywhere.
+
+        @param head: what we read from the start of the file
+        @type  head: str
+
+        @rtype: boolean
+        """
+        if not self.sniffbytes or self.literal is None:
+            return True
+
+        sniffbytes = self.sniffbytes
+        if self.maxbytes and self.maxbytes < sniffbytes:
+            sniffbytes = self.maxbytes
+
+        return head.find(self.literal, 0, sniffbytes) != -1
+
+    def has_andpath(self, installdir, paths=None):
+        """
+        Check that all the "andpath" files are present in the install dir.
+
+        @param installdir: the directory that matched
+        @type  installdir: str
+        @param paths: what we know about files in this scan (None: ask
+                      the filesystem every time)
+        @type  paths: PathCache
+
+        @rtype: boolean
+        """
+        # look for other files relative to this dir to verify
+        # that it's not some other product with similar files
+        for checkpath in self.andpath:
+            fullpath = os.path.normpath(installdir + checkpath)
+            if paths is not None:
+                if not paths.exists(fullpath):
+                    return False
+            elif not os.access(fullpath, os.R_OK):
+                return False
+
+        return True
+
+    def is_secure(self, got_version):
+        """
+        Check whether the version found is at least the secure version.
+
+        @param got_version: the version we found
+        @type  got_version: str
+
+        @rtype: boolean
+        """
+        if self.secure_key is None:
+            return False
+
+        if stats.enabled:
+            started = time.time()
+            result = parse_version(got_version) >= self.secure_key
+            stats.count('version_compares')
+            stats.time('version_compare', started)
+            return result
 
-        return (is_secure, got_version)
+        return parse_version(got_version) >= self.secure_key
 
-def analyze_dir(rootpath, crudfile, quiet, wantenv=[]):
+def guarded_search(product, contents, timeout):
     """
-    Look at all the files in the path provided and attempt to find 
-    the products we recognize.
+    Run the product's regex in a child process, and give up on it if it
+    takes longer than the timeout. Python can't interrupt a regex once
+    it has started, so this is the only way to stop a runaway one. Where
+    we can't fork, it just runs the regex.
+
+    @param product: the product whose regex to run
+    @type  product: CrudProduct
+    @param contents: what to search
+    @type  contents: str or mmap
+    @param timeout: how many seconds to give it
+    @type  timeout: float
+
+    @return: (finished, got_version)
+                finished:    False if we gave up on it
+                got_version: the expanded match, or None if there was 
+                             no match
+    @rtype: tuple
+    """
+    import select, signal
 
-    Returns a report with the findings in the format:
+    if not hasattr(os, 'fork'):
+        match = product.search(contents)
+        if match is None:
+            return (True, None)
+        return (True, match.expand(product.expand))
+
+    (rfd, wfd) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # the child: report back, and leave without cleaning up 
+        # anything that belongs to the parent
+        try:
+            os.close(rfd)
+            match = product.search(contents)
+            if match is None:
+                os.write(wfd, '-')
+            else:
+                os.write(wfd, '+' + match.expand(product.expand))
+        finally:
+            os._exit(0)
+
+    os.close(wfd)
+    deadline = time.time() + timeout
+    chunks = []
+    finished = False
+    while not finished:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        (readable, writable, failed) = select.select([rfd], [], [], 
+                                                     remaining)
+        if not readable:
+            break
+        chunk = os.read(rfd, 4096)
+        if not chunk:
+            finished = True
+        chunks.append(chunk)
+    os.close(rfd)
+
+    if not finished:
+        os.kill(pid, signal.SIGKILL)
+    os.waitpid(pid, 0)
+
+    output = ''.join(chunks)
+    if not finished:
+        return (False, None)
+    if not output.startswith('+'):
+        # no match (or the child died trying)
+        return (True, None)
+
+    return (True, output[1:])
+
+def starts_with_anything(regex, flags=0):
+    """
+    Check whether the regex starts with a ".*" (or ".*?") that can match
+    anything, newlines included.
 
-    @param rootpath: the root path of where to look for crud
-    @type  rootpath: str
-    @param crudfile: the location of crud.ini
+    @param regex: the regular expression
+    @type  regex: str
+    @param flags: the flags it will be compiled with
+    @type  flags: int
+
+    @rtype: boolean
+    """
+    import sre_parse
+    import sre_constants
+
+    parsed = sre_parse.parse(regex, flags)
+    if not parsed.pattern.flags & sre_constants.SRE_FLAG_DOTALL:
+        return False
+    if not len(parsed):
+        return False
+
+    (op, av) = parsed[0]
+    if op not in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+        return False
+
+    (low, high, item) = av
+    return (low == 0 and high == sre_constants.MAXREPEAT and 
+            list(item) == [(sre_constants.ANY, None)])
+
+def required_literal(regex, flags=0):
+    """
+    Find the longest string that anything matching the regex must 
+    contain. Only plain literals at the top level of the regex (or 
+    inside its groups) are considered, which covers the typical crud.ini
+    signature, e.g. "$wp_version" out of "\\$wp_version\\s*=\\s*'([^']+)'".
+
+    @param regex: the regular expression
+    @type  regex: str
+    @param flags: the flags it will be compiled with
+    @type  flags: int
+
+    @return: the literal, or None if there is no useful one
+    @rtype: str
+    """
+    import sre_parse
+    import sre_constants
+
+    parsed = sre_parse.parse(regex, flags)
+    if parsed.pattern.flags & sre_constants.SRE_FLAG_IGNORECASE:
+        return None
+
+    chunks = []
+    chunk  = []
+
+    def walk(parsed):
+        for (op, av) in parsed:
+            if op == sre_constants.LITERAL:
+                chunk.append(chr(av))
+            elif op == sre_constants.SUBPATTERN and av[-1] is not None:
+                walk(av[-1])
+            else:
+                chunks.append(''.join(chunk))
+                del chunk[:]
+
+    walk(parsed)
+    chunks.append(''.join(chunk))
+
+    literal = max(chunks, key=len)
+    if len(literal) < 3:
+        # too short to be worth looking for
+        return None
+
+    return literal
+
+def read_crudfile(crudfile, crudcache=None):
+    """
+    Read the contents of crud.ini, either from a local file or from
+    a URL.
+
+    @param crudfile: the location of crud.ini (path or URL)
     @type  crudfile: str
-    @param quiet: whether to be quiet
-    @type  quiet: boolean
-    @param wantenv: list of environments  (e.g.: ['php', 'perl'], [] means all)
+    @param crudcache: where to keep downloaded copies (None: always
+                      download)
+    @type  crudcache: CrudCache
 
-    @return: List of tuples in the following format:
-                [(installdir, product, status, got_version), ...]
-                installdir:  string, path with the location of the product
-                product:     CrudProduct, the product found
-                status:      string, 'secure' or 'vulnerable'
-                got_version: string, version of the product found
-    @rtype: list
+    @rtype: str
     """
-    config = ConfigParser()
     if crudfile.find('://') > -1:
+        if crudcache is not None:
+            return crudcache.fetch(crudfile)
+
         import urllib2
         req = urllib2.Request(crudfile)
-        crudfp = urllib2.urlopen(req)
+        crudfp = urllib2.urlopen(req, timeout=CRUDTIMEOUT)
     else:
         crudfp = open(crudfile, 'r')
 
-    config.readfp(crudfp)
-    
-    # walk through sections and build path:[section,]
-    # keep the list of filenames in the separate dict for quick matching
-    seekpaths = {}
-    seekfiles = []
-    for section in config.sections():
-        if len(wantenv) > 0:
-            seekenv  = config.get(section, 'env')
-            # do we care about this env?
-            if seekenv not in wantenv:
-                continue
-        seekpath = config.get(section, 'path')
-        if seekpath not in seekpaths.keys():
-            seekpaths[seekpath] = []
+    crudtext = crudfp.read()
+    crudfp.close()
+
+    return crudtext
+
+class CrudCache:
+    """
+    On-disk cache of crud.ini files downloaded from URLs, so that lots
+    of runs (e.g. one per customer from cron) don't all download it.
+
+    A cached copy is used without asking the server for "ttl" seconds.
+    After that, we ask the server whether it changed, using the ETag and
+    Last-Modified headers it sent, and only download it again if it did.
+    If the server can't be reached, or sends something that is not a
+    valid crud.ini, we keep using the last good copy and try again in a
+    few minutes.
+
+    Several processes can share the same cache directory: only one of
+    them checks with the server at a time, and the others wait for it
+    and use what it got. Files are replaced atomically, so nobody reads
+    a partial copy.
+    """
 
-        product = CrudProduct(section, config)
+    def __init__(self, cachedir, ttl=CRUDTTL, timeout=CRUDTIMEOUT):
+        """
+        @param cachedir: directory to keep the copies in
+        @type  cachedir: str
+        @param ttl: how many seconds to use a copy before checking it
+        @type  ttl: int
+        @param timeout: how many seconds to wait for the server
+        @type  timeout: int
+        """
+        self.cachedir = os.path.expanduser(cachedir)
+        self.ttl      = ttl
+        self.timeout  = timeout
 
-        seekpaths[seekpath].append(product)
+    def fetch(self, url):
+        """
+        Get the contents of crud.ini from the url, or from the cache.
 
-        seekfile = os.path.basename(seekpath)
-        if seekfile not in seekfiles:
-            seekfiles.append(seekfile)
-    
-    report = []
+        @param url: where to download crud.ini from
+        @type  url: str
 
-    for root, dirs, files in os.walk(rootpath):
-        if not files:
-            continue
-        for filename in files:
-            if filename not in seekfiles:
-                # quick match and discard
-                continue
-            # slow match against full paths
-            for seekpath in seekpaths.keys():
-                havepath = os.path.join(root, filename)
-                if fnmatch(havepath, '*' + seekpath):
-                    installdir = havepath.replace(seekpath, '')
-                    fh = open(havepath, 'r')
-                    contents = fh.read()
+        @rtype: str
+        """
+        import fcntl, json
+
+        key      = crud_checksum(url)
+        textfile = os.path.join(self.cachedir, key + '.ini')
+        metafile = os.path.join(self.cachedir, key + '.json')
+
+        meta = self._read_meta(metafile)
+        if meta is not None and self._fresh(meta):
+            crudtext = self._read(textfile)
+            if crudtext is not None:
+                return crudtext
+
+        if not os.path.isdir(self.cachedir):
+            try:
+                os.makedirs(self.cachedir)
+            except OSError:
+                # someone else just made it
+                if not os.path.isdir(self.cachedir):
+                    raise
+
+        lockfh = open(os.path.join(self.cachedir, key + '.lock'), 'a')
+        fcntl.flock(lockfh, fcntl.LOCK_EX)
+        try:
+            # someone may have checked it while we waited for the lock
+            meta = self._read_meta(metafile)
+            crudtext = self._read(textfile)
+            if meta is None or crudtext is None:
+                meta = {}
+                crudtext = None
+            elif self._fresh(meta):
+                return crudtext
+
+            (newtext, meta, error) = self._download(url, meta)
+
+            if error is not None:
+                if crudtext is None:
+                    raise error
+                print >> sys.stderr, 'Could not check %s for updates ' \
+                      '(%s), using the copy saved on %s' % (url, error, 
+                            time.ctime(os.path.getmtime(textfile)))
+                meta['failed'] = time.time()
+            else:
+                meta['checked'] = time.time()
+                if newtext is not None:
+                    crudtext = newtext
+                    fh = AtomicFile(textfile)
+                    fh.write(crudtext)
                     fh.close()
-                    for product in seekpaths[seekpath]:
-                        result = product.analyze(installdir, contents) 
-                        if result is None:
-                            continue
-                        (is_secure, got_version) = result
-                        status = 'vulnerable'
-                        if is_secure:
-                            status = 'secure'
-                        else:
-                            if not quiet:
-                                print "[%s] %s found, %s wanted, in %s" % (
-                                        product.name, got_version, 
-                                        product.secure, installdir)
-                            
-                        report.append((installdir, product, status, 
-                                       got_version))
-                        break
 
-    return report
+            fh = AtomicFile(metafile)
+            fh.write(json.dumps(meta))
+            fh.close()
 
-def loadmailmap(mailmapini):
-    """
-    Load mailmap.ini file and return the dict with contents.
-    
-    @param mailmapini: path with mailmap.ini
-    @type  mailmapini: string
+            return crudtext
 
-    @return: dict in the following format:
-             {
-                 '/some/path': {
-                    'fqdn':   'foobar.baz', 
-                    'admins': ['eml1', 'eml2']
-                 },
-                 ...
-             }
-    @rtype dict
+        finally:
+            fcntl.flock(lockfh, fcntl.LOCK_UN)
+            lockfh.close()
+
+    def _download(self, url, meta):
+        """
+        Download crud.ini, unless the server says our copy is current.
+
+        @param url: where to download crud.ini from
+        @type  url: str
+        @param meta: what the server told us about our copy last time 
+                     (empty if we don't have one)
+        @type  meta: dict
+
+        @return: (crudtext, meta, error)
+                    crudtext: the new contents, or None if our copy is
+                              current or there was an error
+                    meta:     the updated meta
+                    error:    the exception, if there was an error
+        @rtype: tuple
+        """
+        import urllib2, httplib
+
+        req = urllib2.Request(url)
+        if meta.get('etag'):
+            req.add_header('If-None-Match', meta['etag'])
+        if meta.get('modified'):
+            req.add_header('If-Modified-Since', meta['modified'])
+
+        try:
+            crudfp = urllib2.urlopen(req, timeout=self.timeout)
+            crudtext = crudfp.read()
+            headers = crudfp.info()
+            crudfp.close()
+        except urllib2.HTTPError, ex:
+            if ex.code == 304:
+                return (None, meta, None)
+            return (None, meta, ex)
+        except (urllib2.URLError, httplib.HTTPException, socket.error), ex:
+            return (None, meta, ex)
+
+        try:
+            parse_crud(crudtext)
+        except Exception, ex:
+            return (None, meta, 
+                    ValueError('%s is not a valid crud.ini: %s' % (url, ex)))
+
+        meta = {
+                'etag':     headers.getheader('ETag'),
+                'modified': headers.getheader('Last-Modified'),
+                }
+
+        return (crudtext, meta, None)
+
+    def _read(self, path):
+        """
+        @return: the contents of the file, or None if it is not there
+        @rtype: str
+        """
+        try:
+            fh = open(path, 'r')
+        except IOError:
+            return None
+        contents = fh.read()
+        fh.close()
+
+        return contents
+
+    def _read_meta(self, metafile):
+        """
+        @return: the saved meta, or None if it is missing or unreadable
+        @rtype: dict
+        """
+        import json
+
+        contents = self._read(metafile)
+        if contents is None:
+            return None
+        try:
+            meta = json.loads(contents)
+        except ValueError:
+            return None
+        if not isinstance(meta, dict) or 'checked' not in meta:
+            return None
+
+        return meta
+
+    def _fresh(self, meta):
+        """
+        Whether the copy is recent enough to use without asking the server.
+
+        @rtype: boolean
+        """
+        now = time.time()
+        if now < meta['checked'] + self.ttl:
+            return True
+        if meta.get('failed') and now < meta['failed'] + min(self.ttl, 
+                                                             CRUDRETRY):
+            # don't hammer a server that is having problems
+            return True
+
+        return False
+
+class SeekIndex:
+    """
+    Lookup structure for all the paths listed in crud.ini. Paths are
+    stored in a trie keyed by path components in reverse order (basename
+    first), so finding which paths a file matches only costs as much as
+    the depth of the file's path, regardless of how many products we
+    know about.
     """
 
-    conf = ConfigParser()
-    conf.read(mailmapini)
+    def __init__(self):
+        #: seekpath: [CrudProduct, ...], in crud.ini order
+        self.products = {}
+        #: the trie: {component: {component: ..., None: seekpath}}
+        self.tree     = {}
+        #: product name: CrudProduct
+        self.byname   = {}
+        #: first path component: [(seekpath, CrudProduct), ...], for 
+        #: products with subdirs to prune once we find them
+        self.roots    = {}
+        #: globs of directories never to walk into
+        self.prunedirs = []
+        #: how deep to walk (0: all the way)
+        self.maxdepth  = 0
+
+    def add(self, seekpath, product):
+        """
+        Add a product to the index.
 
-    mailmap = {}
+        @param seekpath: the path from crud.ini
+        @type  seekpath: str
+        @param product: the product found at that path
+        @type  product: CrudProduct
 
-    for fqdn in conf.sections():
-        path = conf.get(fqdn, 'path')
-        path = os.path.normpath(path) + '/'
+        @rtype: void
+        """
+        if seekpath not in self.products:
+            self.products[seekpath] = []
 
-        admins = comma2array(conf.get(fqdn, 'email'))
+            node = self.tree
+            chunks = seekpath.strip('/').split('/')
+            chunks.reverse()
+            for chunk in chunks:
+                node = node.setdefault(chunk, {})
+            node[None] = seekpath
 
-        mailmap[path] = {'fqdn': fqdn, 'admins': admins}
+        self.products[seekpath].append(product)
+        self.byname[product.name] = product
 
-    return mailmap
+        if product.prune:
+            first = seekpath.strip('/').split('/')[0]
+            self.roots.setdefault(first, []).append((seekpath, product))
+
+    def has_file(self, filename):
+        """
+        Quick check whether any path in the index ends with this basename.
+
+        @rtype: boolean
+        """
+        return filename in self.tree
+
+    def match(self, havepath):
+        """
+        Find all the paths in the index that the file matches.
+
+        @param havepath: full path to the file
+        @type  havepath: str
+
+        @return: list of matching seekpaths, shortest first
+        @rtype: list
+        """
+        matches = []
+        node = self.tree
+        chunks = havepath.split(os.sep)
+        chunks.reverse()
+        for chunk in chunks:
+            node = node.get(chunk)
+            if node is None:
+                break
+            if None in node:
+                matches.append(node[None])
+
+        return matches
+
+def parse_crud(crudtext):
+    """
+    Parse crud.ini contents into a list of products and the global 
+    options from its [DEFAULT] section.
+
+    @param crudtext: the contents of crud.ini
+    @type  crudtext: str
+
+    @return: (products, options)
+                products: [(seekpath, CrudProduct), ...], in crud.ini order
+                options:  {'prunedirs': [glob, ...], 'maxdepth': int}
+    @rtype: tuple
+    """
+    from StringIO import StringIO
+
+    config = ConfigParser()
+    config.readfp(StringIO(crudtext))
+
+    products = []
+    for section in config.sections():
+        seekpath = config.get(section, 'path')
+        products.append((seekpath, CrudProduct(section, config)))
+
+    defaults = config.defaults()
+    options  = {'prunedirs': [], 'maxdepth': 0}
+    if defaults.get('prunedirs'):
+        options['prunedirs'] = comma2array(defaults['prunedirs'])
+    if defaults.get('maxdepth'):
+        options['maxdepth'] = int(defaults['maxdepth'])
+
+    return (products, options)
+
+def build_index(products, wantenv=[], options={}):
+    """
+    Build the lookup index used for finding products.
+
+    @param products: [(seekpath, CrudProduct), ...], as from parse_crud
+    @type  products: list
+    @param wantenv: list of environments  (e.g.: ['php', 'perl'], [] means all)
+    @param options: global options, as from parse_crud
+    @type  options: dict
+
+    @rtype: SeekIndex
+    """
+    index = SeekIndex()
+    for (seekpath, product) in products:
+        # do we care about this env?
+        if len(wantenv) > 0 and product.env not in wantenv:
+            continue
+        index.add(seekpath, product)
+
+    index.prunedirs = options.get('prunedirs', [])
+    index.maxdepth  = options.get('maxdepth', 0)
+
+    return index
+
+def load_seekpaths(crudtext, wantenv=[]):
+    """
+    Parse crud.ini contents and build the lookup index used for
+    finding products.
+
+    @param crudtext: the contents of crud.ini
+    @type  crudtext: str
+    @param wantenv: list of environments  (e.g.: ['php', 'perl'], [] means all)
+
+    @rtype: SeekIndex
+    """
+    (products, options) = parse_crud(crudtext)
+
+    return build_index(products, wantenv, options)
+
+def bundle_path(crudfile):
+    """
+    Where the compiled bundle for this crud.ini lives.
+
+    @rtype: str
+    """
+    return crudfile + '.bundle'
+
+def crud_checksum(contents):
+    """
+    @return: hex sha1 checksum of the string
+    @rtype: str
+    """
+    try:
+        from hashlib import sha1
+    except ImportError:
+        from sha import new as sha1
+
+    return sha1(contents).hexdigest()
+
+def compile_bundle(crudfile, bundlefile=None):
+    """
+    Parse crud.ini and save the results in a compiled bundle, so the
+    next runs can skip parsing it. The bundle starts with a header line
+    containing the bundle format version and the checksum of the rest,
+    which is the pickled list of products and global options.
+
+    @param crudfile: the location of crud.ini
+    @type  crudfile: str
+    @param bundlefile: where to save the bundle (next to crud.ini if None)
+    @type  bundlefile: str
+
+    @return: the location of the bundle
+    @rtype: str
+    """
+    import cPickle
+
+    if bundlefile is None:
+        bundlefile = bundle_path(crudfile)
+
+    crudtext = read_crudfile(crudfile)
+    (products, options) = parse_crud(crudtext)
+    payload  = cPickle.dumps({
+            'crudsum':  crud_checksum(crudtext),
+            'products': products,
+            'options':  options,
+            }, cPickle.HIGHEST_PROTOCOL)
+
+    header = 'CRUDMINER-BUNDLE %d %s\n' % (BUNDLEVERSION,
+                                            crud_checksum(payload))
+
+    fh = AtomicFile(bundlefile, 'wb')
+    fh.write(header)
+    fh.write(payload)
+    fh.close()
+
+    return bundlefile
+
+def load_bundle(bundlefile):
+    """
+    Load the compiled bundle.
+
+    @param bundlefile: the location of the bundle
+    @type  bundlefile: str
+
+    @return: (crudsum, products, options), or None if the bundle 
+             is not usable
+    @rtype: tuple
+    """
+    import cPickle
+
+    try:
+        fh = open(bundlefile, 'rb')
+        header  = fh.readline()
+        payload = fh.read()
+        fh.close()
+    except IOError:
+        return None
+
+    chunks = header.split()
+    if len(chunks) != 3 or chunks[0] != 'CRUDMINER-BUNDLE':
+        return None
+    if chunks[1] != str(BUNDLEVERSION):
+        return None
+    if chunks[2] != crud_checksum(payload):
+        return None
+
+    try:
+        bundle = cPickle.loads(payload)
+    except Exception:
+        return None
+
+    return (bundle['crudsum'], bundle['products'], bundle['options'])
+
+def load_crud(crudfile, wantenv=[], crudcache=None):
+    """
+    Load crud.ini and build the lookup index. If there is a compiled 
+    bundle of the same crud.ini next to it, use the bundle. The bundle
+    is checked against the contents of crud.ini, not its mtime, which
+    "rsync -t" or "cp -p" can set to anything.
+
+    @param crudfile: the location of crud.ini (path or URL)
+    @type  crudfile: str
+    @param wantenv: list of environments  (e.g.: ['php', 'perl'], [] means all)
+    @param crudcache: where to keep downloaded copies of crud.ini
+    @type  crudcache: CrudCache
+
+    @return: (index, crudsum)
+                index:   SeekIndex
+                crudsum: checksum of crud.ini contents
+    @rtype: tuple
+    """
+    crudtext = read_crudfile(crudfile, crudcache)
+    crudsum  = crud_checksum(crudtext)
+
+    if crudfile.find('://') == -1:
+        bundle = load_bundle(bundle_path(crudfile))
+        if bundle is not None and bundle[0] == crudsum:
+            (crudsum, products, options) = bundle
+            return (build_index(products, wantenv, options), crudsum)
+
+    index = load_seekpaths(crudtext, wantenv)
+
+    return (index, crudsum)
+
+def lint_inputs(product, size=LINTSIZE):
+    """
+    Make up some files that are hard on regexes: lots of short lines,
+    one very long line, and the literal the regex needs over and over.
+    All of them contain the literal, so the regex runs on them just like
+    it would during a scan.
+
+    @param product: the product whose regex they are for
+    @type  product: CrudProduct
+    @param size: how big to make them
+    @type  size: int
+
+    @return: list of (name, contents)
+    @rtype: list
+    """
+    literal = product.literal or ''
+
+    inputs = []
+    for (name, unit) in (('many lines', '$foo = "bar";\n'), 
+                         ('one long line', 'x'),
+                         ('repeated literal', literal + ' \n')):
+        if not unit.strip():
+            continue
+        filler = unit * (size / len(unit) + 1)
+        inputs.append((name, (literal + filler)[:size]))
+
+    return inputs
+
+def lint_signatures(crudfile, fixturesdir=None, size=LINTSIZE, 
+                    crudcache=None):
+    """
+    Time every product's regex against the files in fixturesdir that
+    match its path (e.g. the tests), and against made up files that are
+    hard on regexes (see lint_inputs), to find the regexes that could 
+    slow down a scan. Regexes only get as long as their budget (or
+    LINTBUDGET, if they don't have one) on any one file.
+
+    @param crudfile: the location of crud.ini
+    @type  crudfile: str
+    @param fixturesdir: where to look for real files to try (None: only
+                        use the made up ones)
+    @type  fixturesdir: str
+    @param size: how big to make the made up files, for products without
+                 maxbytes
+    @type  size: int
+    @param crudcache: where to keep copies of crud.ini, if it is a URL
+    @type  crudcache: CrudCache
+
+    @return: the worst case of every product, slowest first:
+                [(product, inputname, seconds, finished), ...]
+                product:   CrudProduct
+                inputname: the file (or made up input) it was slowest on
+                seconds:   how long the regex took on it
+                finished:  False if we gave up on it
+    @rtype: list
+    """
+    (index, crudsum) = load_crud(crudfile, [], crudcache)
+
+    #: product name: [(path, contents), ...]
+    fixtures = {}
+    if fixturesdir is not None:
+        for root, dirs, files in os.walk(fixturesdir):
+            dirs.sort()
+            for filename in sorted(files):
+                if not index.has_file(filename):
+                    continue
+                havepath = os.path.join(root, filename)
+                for seekpath in index.match(havepath):
+                    fh = open(havepath, 'rb')
+                    contents = fh.read()
+                    fh.close()
+                    for product in index.products[seekpath]:
+                        fixtures.setdefault(product.name, []).append(
+                                (havepath, contents))
+
+    results = []
+    for name in sorted(index.byname.keys()):
+        product = index.byname[name]
+        budget  = product.budget or LINTBUDGET
+        inputs  = fixtures.get(name, []) + lint_inputs(product, 
+                                                product.maxbytes or size)
+        worst = None
+        for (inputname, contents) in inputs:
+            started = time.time()
+            (finished, got_version) = guarded_search(product, contents, 
+                                                     budget)
+            elapsed = time.time() - started
+
+            if worst is None or elapsed > worst[2] or not finished:
+                worst = (product, inputname, elapsed, finished)
+            if not finished:
+                # no point trying the rest
+                break
+
+        results.append(worst)
+
+    results.sort(key=lambda result: result[2], reverse=True)
+
+    return results
+
+def in_shard(name, shard):
+    """
+    Whether a top-level directory belongs to a shard. Every directory
+    belongs to exactly one of the n shards, and always the same one, no
+    matter which host is asking.
+
+    @param name: the name of the directory
+    @type  name: str
+    @param shard: (k, n), for shard k of n, counting from 1
+    @type  shard: tuple
+
+    @rtype: boolean
+    """
+    import zlib
+
+    (k, n) = shard
+    return (zlib.crc32(name) & 0xffffffff) % n == k - 1
+
+class PathCache:
+    """
+    Remembers which "andpath" files exist during one scan. The walk
+    hands it every directory listing it gets, so most andpath files
+    are known to be there without asking the filesystem again, and
+    whatever else we need to know is only asked about once, no matter
+    how many products or files want to know. Only names that end some
+    product's andpath are remembered from the listings, to keep memory
+    use down on large trees.
+
+    It is safe to use from walker threads. Don't keep one around longer
+    than a scan, since it never notices files going away.
+    """
+
+    def __init__(self, index):
+        """
+        @param index: the products we are looking for
+        @type  index: SeekIndex
+        """
+        #: names that some andpath ends with
+        self.names = set()
+        for product in index.byname.values():
+            for checkpath in product.andpath:
+                self.names.add(os.path.basename(checkpath.rstrip('/')))
+
+        #: full path: whether it exists
+        self.known = {}
+
+    def add_listing(self, root, names):
+        """
+        Remember the andpath files in a directory listing.
+
+        @param root: the directory that was listed
+        @type  root: str
+        @param names: the names of everything in it
+        @type  names: list
+
+        @rtype: void
+        """
+        if not self.names:
+            return
+
+        for name in self.names.intersection(names):
+            self.known[os.path.normpath(os.path.join(root, name))] = True
+
+    def exists(self, path):
+        """
+        Check whether the file exists, asking the filesystem only if we
+        haven't seen it in a listing or asked about it before.
+
+        @param path: normalized full path of the file
+        @type  path: str
+
+        @rtype: boolean
+        """
+        found = self.known.get(path)
+        if found is None:
+            if stats.enabled:
+                stats.count('andpath_lookups')
+            found = os.access(path, os.R_OK)
+            self.known[path] = found
+
+        return found
+
+def andpath_products(products, installdir, paths=None):
+    """
+    Leave out the products whose "andpath" files are missing from the
+    install dir, so we know whether a file is worth reading at all.
+
+    @param products: list of CrudProduct objects sharing a path
+    @type  products: list
+    @param installdir: the install root they would be in
+    @type  installdir: str
+    @param paths: what we know about files in this scan, if anything
+    @type  paths: PathCache
+
+    @return: the products that can be there, in the same order
+    @rtype: list
+    """
+    found = []
+    for product in products:
+        if product.has_andpath(installdir, paths):
+            found.append(product)
+        elif stats.enabled:
+            stats.count('andpath_skips')
+
+    return found
+
+class Pruner:
+    """
+    Decides which directories a walk can skip: those matching the prune
+    globs, those deeper than the maximum depth, and those that products
+    list in "prune" as not worth looking into, once we find the product
+    installed in their parent. When scanning one shard of the tree, it
+    also skips the top-level directories that belong to other shards.
+
+    One Pruner is used per walk. It is safe to use from walker threads.
+    """
+
+    def __init__(self, rootpath, index, prunedirs=[], maxdepth=0, 
+                 shard=None, paths=None):
+        """
+        @param rootpath: the root path of the walk
+        @type  rootpath: str
+        @param index: the products we are looking for
+        @type  index: SeekIndex
+        @param prunedirs: globs of directories to skip, matched against
+                          the directory name, or against the full path
+                          if the glob contains a "/"
+        @type  prunedirs: list
+        @param maxdepth: how many levels below rootpath to walk (0: all)
+        @type  maxdepth: int
+        @param shard: (k, n) to only walk shard k of n (see in_shard),
+                      None to walk everything
+        @type  shard: tuple
+        @param paths: where to remember the andpath files in the
+                      listings we see, if anywhere
+        @type  paths: PathCache
+        """
+        self.rootpath  = rootpath.rstrip(os.sep)
+        self.shard     = shard
+        self.index     = index
+        self.prunedirs = prunedirs
+        self.maxdepth  = maxdepth
+        self.rootdepth = rootpath.rstrip(os.sep).count(os.sep)
+        #: full paths of the subdirs of found products we won't walk into
+        self.skip      = set()
+        self.paths     = paths
+
+    def prune(self, root, dirs, files):
+        """
+        Remove the directories we don't need to walk into from dirs,
+        just like one would do with the dirs returned by os.walk.
+
+        @param root: the directory being walked
+        @type  root: str
+        @param dirs: its subdirectories, modified in place
+        @type  dirs: list
+        @param files: its files
+        @type  files: list
+
+        @rtype: void
+        """
+        if self.paths is not None:
+            self.paths.add_listing(root, dirs + files)
+
+        if self.shard is not None and root.rstrip(os.sep) == self.rootpath:
+            dirs[:] = [name for name in dirs if in_shard(name, self.shard)]
+            if self.shard[0] != 1:
+                # files at the top belong to the first shard
+                del files[:]
+
+        if self.maxdepth:
+            depth = root.rstrip(os.sep).count(os.sep) - self.rootdepth
+            if depth >= self.maxdepth:
+                del dirs[:]
+                return
+
+        if self.index.roots:
+            # is this the install root of any product we know
+            # has directories not worth looking into?
+            for name in dirs + files:
+                for (seekpath, product) in self.index.roots.get(name, ()):
+                    havepath = os.path.join(root, seekpath.lstrip('/'))
+                    if not os.path.isfile(havepath):
+                        continue
+                    if not product.has_andpath(havepath[:-len(seekpath)],
+                                               self.paths):
+                        continue
+                    for prunepath in product.prune:
+                        self.skip.add(os.path.normpath(
+                            os.path.join(root, prunepath.lstrip('/'))))
+
+        for name in dirs[:]:
+            if self.skip and os.path.join(root, name) in self.skip:
+                dirs.remove(name)
+                continue
+            for glob in self.prunedirs:
+                if stats.enabled:
+                    stats.count('fnmatch_calls')
+                if glob.find('/') > -1:
+                    matched = fnmatch(os.path.join(root, name), glob)
+                else:
+                    matched = fnmatch(name, glob)
+                if matched:
+                    dirs.remove(name)
+                    break
+
+class ScanCache:
+    """
+    Persistent cache of previous scan results, kept in its own sqlite
+    database. Entries are keyed by the file path and the crud.ini path
+    it matched, and are only reused if the inode, size and mtime of the
+    file, the signature of crud.ini, and the products whose "andpath"
+    files were there (see andpath_key) are all unchanged.
+
+    All entries for the current crud.ini are loaded into memory when
+    the cache is opened, so lookups are safe to do from walker threads.
+    Results are written back in one transaction by save().
+    """
+
+    def __init__(self, cachefile, crudhash, full=False):
+        """
+        @param cachefile: the location of the cache database
+        @type  cachefile: str
+        @param crudhash: signature of crud.ini and wanted environments
+        @type  crudhash: str
+        @param full: ignore existing entries and rescan everything
+        @type  full: boolean
+        """
+        self.crudhash = crudhash
+        #: (path, seekpath): (inode, size, mtime, andpath, product_name,
+        #: found_version)
+        self.entries  = {}
+        #: entries seen during this run, to be written out by save()
+        self.seen     = {}
+
+        self.sconn = sqlite.connect(cachefile)
+        # paths are whatever bytes the filesystem gave us, and should
+        # come back the same way
+        self.sconn.text_factory = str
+        scursor = self.sconn.cursor()
+
+        # it's only a cache, so start over if it's from an older version
+        scursor.execute("PRAGMA user_version")
+        if scursor.fetchone()[0] != SCANCACHEVERSION:
+            scursor.execute("DROP TABLE IF EXISTS scancache")
+            scursor.execute("PRAGMA user_version = %d" % SCANCACHEVERSION)
+
+        query = """CREATE TABLE IF NOT EXISTS scancache (
+                          path          TEXT,
+                          seekpath      TEXT,
+                          inode         INTEGER,
+                          size          INTEGER,
+                          mtime         REAL,
+                          crudhash      TEXT,
+                          andpath       TEXT,
+                          product_name  TEXT,
+                          found_version TEXT,
+                          PRIMARY KEY (path, seekpath))"""
+        scursor.execute(query)
+        self.sconn.commit()
+
+        if not full:
+            query = """
+                SELECT path, seekpath, inode, size, mtime, andpath,
+                       product_name, found_version
+                  FROM scancache
+                 WHERE crudhash = ?"""
+            scursor.execute(query, (crudhash,))
+            for row in scursor.fetchall():
+                self.entries[(row[0], row[1])] = tuple(row[2:])
+
+    def lookup(self, havepath, seekpath, st, andpath):
+        """
+        Look for a previous result for this file.
+
+        @param havepath: full path to the file
+        @type  havepath: str
+        @param seekpath: the crud.ini path it matched
+        @type  seekpath: str
+        @param st: result of os.stat() on the file
+        @param andpath: the andpath_key of the products to try
+        @type  andpath: str
+
+        @return: None if we must rescan, otherwise 
+                 (product_name, found_version), where both are None
+                 if no product was found in the file last time
+        @rtype: tuple
+        """
+        entry = self.entries.get((havepath, seekpath))
+        if entry is None:
+            return None
+
+        (inode, size, mtime, oldandpath, product_name, found_version) = entry
+        if (inode, size, mtime) != (st.st_ino, st.st_size, st.st_mtime):
+            return None
+        if oldandpath != andpath:
+            return None
+
+        self.seen[(havepath, seekpath)] = entry
+
+        return (product_name, found_version)
+
+    def store(self, havepath, seekpath, st, andpath, product_name, 
+              found_version):
+        """
+        Remember the result of analyzing a file.
+
+        @rtype: void
+        """
+        self.seen[(havepath, seekpath)] = (st.st_ino, st.st_size, 
+                st.st_mtime, andpath, product_name, found_version)
+
+    def save(self, rootpath):
+        """
+        Write out all entries seen during this run, dropping the ones
+        for files under rootpath that are no longer there.
+
+        @param rootpath: the root path that was scanned
+        @type  rootpath: str
+
+        @rtype: void
+        """
+        prefix = os.path.join(rootpath, '')
+
+        scursor = self.sconn.cursor()
+        query = "DELETE FROM scancache WHERE substr(path, 1, ?) = ?"
+        scursor.execute(query, (len(prefix), prefix))
+
+        query = """
+            INSERT OR REPLACE INTO scancache
+                   (path, seekpath, inode, size, mtime, crudhash,
+                    andpath, product_name, found_version)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+        rows = []
+        for ((havepath, seekpath), entry) in self.seen.items():
+            (inode, size, mtime, andpath, product_name, found_version) = entry
+            rows.append((havepath, seekpath, inode, size, mtime, 
+                         self.crudhash, andpath, product_name, 
+                         found_version))
+        scursor.executemany(query, rows)
+
+        self.sconn.commit()
+        self.sconn.close()
+
+def crud_signature(crudsum, wantenv=[]):
+    """
+    Get a signature of crud.ini and the wanted environments, used to 
+    invalidate cached scan results when the definitions change.
+
+    @param crudsum: checksum of crud.ini contents
+    @type  crudsum: str
+
+    @rtype: str
+    """
+    envs = list(wantenv)
+    envs.sort()
+
+    return crud_checksum(crudsum + '\0' + ','.join(envs))
+
+def andpath_key(products):
+    """
+    Which products sharing a path had their "andpath" files in place
+    (see andpath_products). A cached result only holds as long as the
+    same ones do: if another product's files appear, it may be the one
+    to find in the file now.
+
+    @param products: list of CrudProduct objects left to try
+    @type  products: list
+
+    @rtype: str
+    """
+    return '\n'.join([product.name for product in products])
+
+def cached_result(cache, index, havepath, seekpath, st, products):
+    """
+    Find the result of a previous analysis of this file in the cache.
+
+    @param products: the products to try, with their "andpath" files 
+                     checked for this run (see andpath_products)
+    @type  products: list
+
+    @return: False if the file needs to be analyzed, otherwise the same
+             as analyze_file()
+    """
+    cached = cache.lookup(havepath, seekpath, st, andpath_key(products))
+    if cached is None:
+        return False
+
+    if stats.enabled:
+        stats.count('cache_hits')
+
+    (product_name, got_version) = cached
+    if product_name is None:
+        return None
+
+    product = index.byname.get(product_name)
+    if product is None:
+        return False
+
+    status = 'vulnerable'
+    if product.is_secure(got_version):
+        status = 'secure'
+
+    return (product, status, got_version)
+
+def store_result(cache, havepath, seekpath, st, products, result):
+    """
+    Store the result of analyze_file() in the cache.
+
+    @param products: the products that were tried (see cached_result)
+    @type  products: list
+
+    @rtype: void
+    """
+    andpath = andpath_key(products)
+    if result is None:
+        cache.store(havepath, seekpath, st, andpath, None, None)
+    else:
+        (product, status, got_version) = result
+        cache.store(havepath, seekpath, st, andpath, product.name, 
+                    got_version)
+
+def analyze_file(havepath, installdir, products, st=None):
+    """
+    Read a candidate file and run the regexes of the products sharing
+    its path against it, in order. The first product that matches wins.
+    The "andpath" files are not checked here: leave out the products
+    whose files are missing first (see andpath_products), so we don't
+    read the file at all if none of them can be there.
+
+    @param havepath: full path to the file
+    @type  havepath: str
+    @param installdir: the install root of the product
+    @type  installdir: str
+    @param products: list of CrudProduct objects to try
+    @type  products: list
+    @param st: os.stat of the file, if we have it already
+    @type  st: posix.stat_result
+
+    @return: (product, status, got_version) or None
+    @rtype: tuple
+    """
+    (contents, products) = read_file(havepath, products, True, st)
+    if contents is None:
+        return None
+
+    return analyze_contents(installdir, contents, products)
+
+def read_file(havepath, products, mapped=True, st=None):
+    """
+    Read as much of a candidate file as the products sharing its path
+    will look at, once we know it's worth it. Products go out first if
+    the file is not the right size for them, then if the literal their
+    regex needs is not in the first few KB of the file where they 
+    expect it (see sniffbytes). Only the first few KB are read for that,
+    and the rest of the file only if any products are left.
+
+    @param havepath: full path to the file
+    @type  havepath: str
+    @param products: list of CrudProduct objects that will look at it
+    @type  products: list
+    @param mapped: map the file into memory instead of reading it, if
+                   we can (see read_contents)
+    @type  mapped: boolean
+    @param st: os.stat of the file, if we have it already
+    @type  st: posix.stat_result
+
+    @return: (contents, products)
+                contents: the contents of the file, as mmap or str, or
+                          None if no products are left
+                products: the products left, in the same order
+    @rtype: tuple
+    """
+    if st is None:
+        st = os.stat(havepath)
+
+    fitting = [product for product in products 
+               if product.fits_size(st.st_size)]
+    if stats.enabled and len(fitting) < len(products):
+        stats.count('size_skips', len(products) - len(fitting))
+    products = fitting
+    if not products:
+        return (None, products)
+
+    # we only need as much of the file as the greediest product wants,
+    # and don't need to sniff more than the greediest sniffer wants
+    maxbytes   = 0
+    sniffbytes = 0
+    for product in products:
+        if product.sniffbytes and product.literal is not None:
+            sniffbytes = max(sniffbytes, product.sniffbytes)
+    for product in products:
+        if not product.maxbytes:
+            maxbytes = 0
+            break
+        maxbytes = max(maxbytes, product.maxbytes)
+
+    if stats.enabled:
+        started = time.time()
+
+    contents = None
+    fh = open(havepath, 'rb')
+    try:
+        if sniffbytes:
+            head = fh.read(sniffbytes)
+            if stats.enabled:
+                stats.count('bytes_read', len(head))
+
+            sniffed = [product for product in products 
+                       if product.in_sniff(head)]
+            if stats.enabled and len(sniffed) < len(products):
+                stats.count('sniff_skips', len(products) - len(sniffed))
+            products = sniffed
+
+            if not products:
+                if stats.enabled:
+                    stats.time('read', started)
+                return (None, products)
+
+            if (len(head) < sniffbytes 
+                    or (maxbytes and maxbytes <= len(head))):
+                # that's all we need
+                contents = head
+
+        if contents is None:
+            fh.seek(0)
+            if mapped:
+                contents = read_contents(fh, maxbytes)
+            elif maxbytes:
+                contents = fh.read(maxbytes)
+            else:
+                contents = fh.read()
+            if stats.enabled:
+                stats.count('bytes_read', len(contents))
+    finally:
+        fh.close()
+
+    if stats.enabled:
+        stats.time('read', started)
+        stats.count('files_read')
+
+    return (contents, products)
+
+def analyze_contents(installdir, contents, products):
+    """
+    Run the regexes of the products sharing a path against the contents
+    of a file, in order. The first product that matches wins. If the 
+    contents are mapped, they are unmapped afterwards.
+
+    @param installdir: the install root of the product
+    @type  installdir: str
+    @param contents: what read_file got out of the file
+    @type  contents: mmap or str
+    @param products: list of CrudProduct objects to try
+    @type  products: list
+
+    @return: (product, status, got_version) or None
+    @rtype: tuple
+    """
+    # literals found in the file, shared between all the products
+    literals = {}
+
+    try:
+        for product in products:
+            result = product.analyze(installdir, contents, literals)
+            if result is None:
+                continue
+            (is_secure, got_version) = result
+            status = 'vulnerable'
+            if is_secure:
+                status = 'secure'
+
+            return (product, status, got_version)
+    finally:
+        if not isinstance(contents, str):
+            contents.close()
+
+    return None
+
+def read_contents(fh, maxbytes=0):
+    """
+    Map the start of the file into memory, so the regexes can run 
+    against it without copying it into a string. If the file cannot
+    be mapped (e.g. it is empty), fall back to reading it.
+
+    @param fh: open file
+    @type  fh: file
+    @param maxbytes: how much of the file we need (0: all of it)
+    @type  maxbytes: int
+
+    @return: the contents of the file
+    @rtype: mmap or str
+    """
+    import mmap
+
+    size = os.fstat(fh.fileno()).st_size
+    if maxbytes and maxbytes < size:
+        size = maxbytes
+
+    try:
+        return mmap.mmap(fh.fileno(), size, access=mmap.ACCESS_READ)
+    except (ValueError, EnvironmentError):
+        if maxbytes:
+            return fh.read(maxbytes)
+        return fh.read()
+
+def walk_key(rootpath, havepath, order):
+    """
+    Sort key that puts findings in the same order a top-down walk with
+    sorted directory listings would produce them, so parallel scans
+    report things in the same order as serial ones.
+
+    @rtype: tuple
+    """
+    chunks = havepath[len(rootpath):].strip(os.sep).split(os.sep)
+    key = [(1, chunk) for chunk in chunks[:-1]]
+    key.append((0, chunks[-1]))
+    key.append(order)
+
+    return tuple(key)
+
+def walk_parallel(rootpath, threads, visit):
+    """
+    Walk the directory tree using several threads, calling 
+    visit(root, dirs, files) for each directory found, just like 
+    os.walk would return it. Like with os.walk, visit can remove entries
+    from dirs to keep the walk from going into them. Like os.walk, does
+    not follow symlinks to directories and ignores directories it cannot
+    list.
+
+    @param rootpath: where to start the walk
+    @type  rootpath: str
+    @param threads: how many walker threads to run
+    @type  threads: int
+    @param visit: callback, called from the walker threads
+    @type  visit: function
+
+    @rtype: void
+    """
+    import Queue
+
+    dirqueue = Queue.Queue()
+    errors   = []
+
+    def walker():
+        while True:
+            top = dirqueue.get()
+            if top is None:
+                dirqueue.task_done()
+                return
+            try:
+                try:
+                    names = os.listdir(top)
+                except os.error:
+                    names = None
+
+                if names is not None:
+                    dirs  = []
+                    files = []
+                    for name in names:
+                        if os.path.isdir(os.path.join(top, name)):
+                            dirs.append(name)
+                        else:
+                            files.append(name)
+
+                    try:
+                        visit(top, dirs, files)
+                    except Exception:
+                        errors.append(sys.exc_info())
+
+                    for name in dirs:
+                        path = os.path.join(top, name)
+                        if not os.path.islink(path):
+                            dirqueue.put(path)
+            finally:
+                dirqueue.task_done()
+
+    workers = []
+    for i in range(threads):
+        worker = threading.Thread(target=walker)
+        worker.setDaemon(True)
+        worker.start()
+        workers.append(worker)
+
+    dirqueue.put(rootpath)
+    dirqueue.join()
+
+    for worker in workers:
+        dirqueue.put(None)
+    for worker in workers:
+        worker.join()
+
+    if errors:
+        (exctype, excvalue, exctb) = errors[0]
+        raise exctype, excvalue, exctb
+
+# Per-process state of the analysis pool workers
+_pool_index = None
+
+def _pool_init(index):
+    """
+    Initializer for the analysis pool processes. The index is inherited
+    from the parent when the pool forks.
+    """
+    global _pool_index
+    _pool_index = index
+
+def _pool_analyze(havepath, installdir, seekpath, names):
+    """
+    Run analyze_file inside an analysis pool process. Products are
+    passed in and back by name, since the parent has its own copies. 
+    The stats collected while analyzing the file, if any, are passed 
+    back along with the result.
+
+    @param names: names of the products to try, whose andpath files 
+                  the parent found
+    @type  names: list
+
+    @return: (result, stats snapshot or None)
+    """
+    snapshot = None
+    if stats.enabled:
+        stats.reset()
+
+    products = [product for product in _pool_index.products[seekpath]
+                if product.name in names]
+    result = analyze_file(havepath, installdir, products)
+    if result is not None:
+        (product, status, got_version) = result
+        result = (product.name, status, got_version)
+
+    if stats.enabled:
+        snapshot = stats.snapshot()
+
+    return (result, snapshot)
+
+class Report:
+    """
+    The findings of a scan, kept in columns instead of a tuple per 
+    finding, since a scan of a whole hosting fleet can find millions of
+    them. Install dirs are split into the directory they are in, which 
+    is kept once and referred to by number, and their own name, which is
+    shared with all the other install dirs of the same name. Products
+    are referred to by number too, and the status takes one byte.
+
+    Going through a Report gives back the same (installdir, product, 
+    status, got_version) tuples that were added, in the same order, so 
+    it can be used wherever a list of findings can.
+    """
+
+    def __init__(self, unique=False):
+        """
+        @param unique: leave out findings already in the report (the 
+                       same version of the same product in the same
+                       install dir)
+        @type  unique: boolean
+        """
+        from array import array
+
+        #: the directories the install dirs are in
+        self.prefixes   = []
+        #: the products found
+        self.products   = []
+        #: the number of the prefix of every finding
+        self.prefixids  = array('l')
+        #: the name of the install dir of every finding
+        self.names      = []
+        #: the number of the product of every finding
+        self.productids = array('l')
+        #: 1 for every finding that is secure, 0 if vulnerable
+        self.secure     = array('b')
+        #: the version of every finding
+        self.versions   = []
+
+        # prefix: number, product name: number
+        self._prefixids  = {}
+        self._productids = {}
+        # one copy of every install dir name and version
+        self._strings    = {}
+        # prefix number: normalized prefix, as vulnerable() needs them
+        self._normprefixes = {}
+        # (prefix number, name, product number, version) of every finding
+        self._seen = None
+        if unique:
+            self._seen = set()
+
+    def add(self, installdir, product, status, got_version):
+        """
+        Add a finding.
+
+        @return: False if it was left out, because it's already there
+        @rtype: boolean
+        """
+        cut = installdir.rfind(os.sep) + 1
+        prefix = installdir[:cut]
+        prefixid = self._prefixids.get(prefix)
+        if prefixid is None:
+            prefixid = len(self.prefixes)
+            self._prefixids[prefix] = prefixid
+            self.prefixes.append(prefix)
+
+        productid = self._productids.get(product.name)
+        if productid is None:
+            productid = len(self.products)
+            self._productids[product.name] = productid
+            self.products.append(product)
+
+        name = installdir[cut:]
+        name = self._strings.setdefault(name, name)
+        got_version = self._strings.setdefault(got_version, got_version)
+
+        if self._seen is not None:
+            key = (prefixid, name, productid, got_version)
+            if key in self._seen:
+                return False
+            self._seen.add(key)
+
+        self.prefixids.append(prefixid)
+        self.names.append(name)
+        self.productids.append(productid)
+        self.secure.append(status == 'secure')
+        self.versions.append(got_version)
+
+        return True
+
+    def __len__(self):
+        return len(self.secure)
+
+    def __getitem__(self, i):
+        status = 'vulnerable'
+        if self.secure[i]:
+            status = 'secure'
+
+        return (self.prefixes[self.prefixids[i]] + self.names[i],
+                self.products[self.productids[i]], status, self.versions[i])
+
+    def __iter__(self):
+        for i in xrange(len(self.secure)):
+            yield self[i]
+
+    def vulnerable(self):
+        """
+        Go through the vulnerable findings only, with install dirs 
+        normalized the way the nagstate database has them, ending with
+        a "/". Every prefix is only normalized once.
+
+        @return: generator of (installdir, product, got_version)
+        @rtype: generator
+        """
+        for i in xrange(len(self.secure)):
+            if self.secure[i]:
+                continue
+
+            prefixid = self.prefixids[i]
+            name     = self.names[i]
+            if name in ('', '.', '..'):
+                installdir = os.path.normpath(self.prefixes[prefixid] + 
+                                              name) + '/'
+            else:
+                normprefix = self._normprefixes.get(prefixid)
+                if normprefix is None:
+                    normprefix = ''
+                    if self.prefixes[prefixid]:
+                        normprefix = os.path.normpath(self.prefixes[prefixid])
+                    if normprefix == os.curdir:
+                        normprefix = ''
+                    self._normprefixes[prefixid] = normprefix
+                installdir = os.path.join(normprefix, name) + '/'
+
+            yield (installdir, self.products[self.productids[i]],
+                   self.versions[i])
+
+    def reordered(self, order):
+        """
+        Get a copy of the report with the findings in a different order.
+
+        @param order: positions of the findings in this report, in the
+                      order they should be in the copy
+        @type  order: list
+
+        @rtype: Report
+        """
+        from array import array
+
+        report = Report()
+        report.prefixes     = self.prefixes
+        report.products     = self.products
+        report._prefixids   = self._prefixids
+        report._productids  = self._productids
+        report._strings     = self._strings
+        report._normprefixes = self._normprefixes
+
+        report.prefixids  = array('l', [self.prefixids[i] for i in order])
+        report.names      = [self.names[i] for i in order]
+        report.productids = array('l', [self.productids[i] for i in order])
+        report.secure     = array('b', [self.secure[i] for i in order])
+        report.versions   = [self.versions[i] for i in order]
+
+        return report
+
+def nag_candidates(findings):
+    """
+    Get the vulnerable findings, with install dirs normalized the way
+    the nagstate database has them (see Report.vulnerable).
+
+    @param findings: a Report, or any other iterable of
+                     (installdir, product, status, got_version)
+    @type  findings: iterable
+
+    @return: iterable of (installdir, product, got_version)
+    @rtype: iterable
+    """
+    if isinstance(findings, Report):
+        return findings.vulnerable()
+
+    return ((os.path.normpath(installdir) + '/', product, got_version)
+            for (installdir, product, status, got_version) in findings
+            if status != 'secure')
+
+def analyze_dir(rootpath, crudfile, quiet, wantenv=[], jobs=1, 
+                cachefile=None, full=False, prunedirs=[], maxdepth=0,
+                crudcache=None, shard=None, iothreads=0):
+    """
+    Look at all the files in the path provided and attempt to find 
+    the products we recognize.
+
+    Returns a report with the findings in the format:
+
+    @param rootpath: the root path of where to look for crud
+    @type  rootpath: str
+    @param crudfile: the location of crud.ini
+    @type  crudfile: str
+    @param quiet: whether to be quiet
+    @type  quiet: boolean
+    @param wantenv: list of environments  (e.g.: ['php', 'perl'], [] means all)
+    @param jobs: how many walker threads and analysis processes to run
+                 (1 means do everything in this process)
+    @type  jobs: int
+    @param cachefile: where to keep results between runs, so unchanged
+                      files do not need to be read again (None: no cache)
+    @type  cachefile: str
+    @param full: ignore the cached results and read every file
+    @type  full: boolean
+    @param prunedirs: globs of directories not to walk into, in addition
+                      to the ones in crud.ini (see Pruner)
+    @type  prunedirs: list
+    @param maxdepth: how many levels below rootpath to walk, overriding
+                     crud.ini (0: use crud.ini setting)
+    @type  maxdepth: int
+    @param crudcache: where to keep copies of crud.ini, if it is a URL
+                      (None: download it every time)
+    @type  crudcache: CrudCache
+    @param shard: (k, n) to only scan shard k of n of the top-level
+                  directories under rootpath (see in_shard)
+    @type  shard: tuple
+    @param iothreads: how many threads to list directories and read
+                      files in, for trees on network filesystems (0: 
+                      don't; the regexes still run in this process, and
+                      jobs is ignored)
+    @type  iothreads: int
+
+    @return: Report of tuples in the following format:
+                [(installdir, product, status, got_version), ...]
+                installdir:  string, path with the location of the product
+                product:     CrudProduct, the product found
+                status:      string, 'secure' or 'vulnerable'
+                got_version: string, version of the product found
+    @rtype: Report
+    """
+    report = Report()
+    keys   = []
+    for (key, finding) in _iter_findings(rootpath, crudfile, quiet, wantenv,
+                                         jobs, cachefile, full, prunedirs,
+                                         maxdepth, crudcache, shard, 
+                                         iothreads):
+        report.add(*finding)
+        keys.append(key)
+
+    if jobs > 1 or iothreads > 1:
+        # put them in the same order as a serial scan would
+        order = range(len(keys))
+        order.sort(key=keys.__getitem__)
+        report = report.reordered(order)
+
+    return report
+
+def iter_analyze_dir(rootpath, crudfile, quiet, wantenv=[], jobs=1, 
+                     cachefile=None, full=False, prunedirs=[], maxdepth=0,
+                     crudcache=None, shard=None, iothreads=0):
+    """
+    Same as analyze_dir, but yield the findings one by one as soon as
+    they are found, instead of returning them all at the end. When 
+    running several jobs, findings come out in the order the files are
+    found, which is not the same from one run to the next.
+
+    @return: generator of (installdir, product, status, got_version)
+    @rtype: generator
+    """
+    for (key, finding) in _iter_findings(rootpath, crudfile, quiet, wantenv,
+                                         jobs, cachefile, full, prunedirs,
+                                         maxdepth, crudcache, shard, 
+                                         iothreads):
+        yield finding
+
+def _iter_findings(rootpath, crudfile, quiet, wantenv, jobs, cachefile, full,
+                   prunedirs, maxdepth, crudcache, shard, iothreads):
+    """
+    Generator doing the work for analyze_dir and iter_analyze_dir.
+
+    @return: generator of (key, (installdir, product, status, got_version)),
+             where key is the walk_key of the finding when running
+             several jobs or I/O threads, and None otherwise.
+    @rtype: generator
+    """
+    started = time.time()
+    (index, crudsum) = load_crud(crudfile, wantenv, crudcache)
+    if stats.enabled:
+        stats.time('load_crud', started)
+        started = time.time()
+
+    cache = None
+    if cachefile is not None:
+        cache = ScanCache(cachefile, crud_signature(crudsum, wantenv), full)
+
+    pruner = Pruner(rootpath, index, index.prunedirs + list(prunedirs),
+                    maxdepth or index.maxdepth, shard, PathCache(index))
+
+    if iothreads > 1:
+        findings = _iter_pipeline(rootpath, iothreads, index, cache, pruner)
+    elif jobs > 1:
+        findings = _iter_parallel(rootpath, jobs, index, cache, pruner)
+    else:
+        findings = _iter_serial(rootpath, index, cache, pruner)
+
+    for (key, finding) in findings:
+        (installdir, product, status, got_version) = finding
+        if status == 'vulnerable' and not quiet:
+            print "[%s] %s found, %s wanted, in %s" % (
+                    product.name, got_version, 
+                    product.secure, installdir)
+
+        yield (key, finding)
+
+    # only save after a complete walk, otherwise
+    # we would forget about the files we did not get to
+    if cache is not None:
+        cache.save(rootpath)
+
+    if stats.enabled:
+        # including whatever the caller did with the findings meanwhile
+        stats.time('analyze_dir', started)
+
+def _timed(iterable, phase):
+    """
+    Go through an iterable, adding the time it takes to get every item
+    to a phase of the stats.
+
+    @rtype: generator
+    """
+    iterator = iter(iterable)
+    while True:
+        started = time.time()
+        try:
+            item = iterator.next()
+        finally:
+            stats.time(phase, started)
+        yield item
+
+def _iter_serial(rootpath, index, cache, pruner):
+    """
+    The analyze_dir scanning loop, when everything happens in this process.
+
+    @rtype: generator
+    """
+    walk = os.walk(rootpath)
+    if stats.enabled:
+        walk = _timed(walk, 'walk')
+
+    for root, dirs, files in walk:
+        # sort, so the order of findings does not depend
+        # on the order in which the filesystem lists things
+        dirs.sort()
+        if stats.enabled:
+            started = time.time()
+        pruner.prune(root, dirs, files)
+        if stats.enabled:
+            stats.time('prune', started)
+            stats.count('dirs_walked')
+            stats.count('files_considered', len(files))
+        if not files:
+            continue
+        for filename in sorted(files):
+            if not index.has_file(filename):
+                # quick match and discard
+                continue
+            if stats.enabled:
+                stats.count('seekfile_hits')
+            havepath = os.path.join(root, filename)
+            st = None
+            if stats.enabled:
+                started = time.time()
+            seekpaths = index.match(havepath)
+            if stats.enabled:
+                stats.time('match', started)
+            for seekpath in seekpaths:
+                installdir = havepath[:-len(seekpath)]
+                if stats.enabled:
+                    started = time.time()
+                products = andpath_products(index.products[seekpath],
+                                            installdir, pruner.paths)
+                if stats.enabled:
+                    stats.time('andpath', started)
+                if not products:
+                    continue
+                result = False
+                if cache is not None:
+                    if st is None:
+                        st = os.stat(havepath)
+                    result = cached_result(cache, index, havepath,
+                                           seekpath, st, products)
+                if result is False:
+                    result = analyze_file(havepath, installdir, products,
+                                          st)
+                    if cache is not None:
+                        store_result(cache, havepath, seekpath, st, 
+                                     products, result)
+                if result is None:
+                    continue
+
+                (product, status, got_version) = result
+                yield (None, (installdir, product, status, got_version))
+
+def _candidates(rootpath, root, dirs, files, index, cache, pruner):
+    """
+    What the threaded walks do with every directory they list: prune
+    it, and find the files in it worth analyzing, along with the cached
+    result of analyzing them, if any. Called from the walker threads.
+
+    @return: generator of 
+             (key, havepath, installdir, seekpath, st, products, result),
+             where key is the walk_key, st the os.stat of the file if 
+             we needed it, products the ones to try, and result the
+             cached result (see cached_result)
+    @rtype: generator
+    """
+    if stats.enabled:
+        started = time.time()
+    pruner.prune(root, dirs, files)
+    if stats.enabled:
+        stats.time('prune', started)
+        stats.count('dirs_walked')
+        stats.count('files_considered', len(files))
+    for filename in files:
+        if not index.has_file(filename):
+            continue
+        if stats.enabled:
+            stats.count('seekfile_hits')
+        havepath = os.path.join(root, filename)
+        st = None
+        order = 0
+        if stats.enabled:
+            started = time.time()
+        seekpaths = index.match(havepath)
+        if stats.enabled:
+            stats.time('match', started)
+        for seekpath in seekpaths:
+            installdir = havepath[:-len(seekpath)]
+            key = walk_key(rootpath, havepath, order)
+            order += 1
+            if stats.enabled:
+                started = time.time()
+            products = andpath_products(index.products[seekpath],
+                                        installdir, pruner.paths)
+            if stats.enabled:
+                stats.time('andpath', started)
+            if not products:
+                continue
+            result = False
+            if cache is not None:
+                if st is None:
+                    st = os.stat(havepath)
+                result = cached_result(cache, index, havepath, seekpath, 
+                                       st, products)
+            yield (key, havepath, installdir, seekpath, st, products, 
+                   result)
+
+def _iter_parallel(rootpath, jobs, index, cache, pruner):
+    """
+    The analyze_dir scanning loop, when running several jobs. The tree is
+    walked by "jobs" threads, and matched files are handed to a pool of 
+    "jobs" processes for reading and regex matching. Findings are yielded
+    in the order the files were found.
+
+    @rtype: generator
+    """
+    import multiprocessing
+    import Queue
+
+    # start the pool before any threads exist
+    pool = multiprocessing.Pool(jobs, _pool_init, (index,))
+
+    # files found by the walkers, waiting to be yielded. Bounded, so
+    # the walkers wait for us if analysis can't keep up with them.
+    pending = Queue.Queue(jobs * 256)
+    errors  = []
+
+    def visit(root, dirs, files):
+        for candidate in _candidates(rootpath, root, dirs, files, index,
+                                     cache, pruner):
+            (key, havepath, installdir, seekpath, st, products, 
+             result) = candidate
+            if result is not False:
+                pending.put((key, havepath, installdir, seekpath, st, 
+                             products, None, result))
+                continue
+            names = [product.name for product in products]
+            asyncres = pool.apply_async(_pool_analyze,
+                    (havepath, installdir, seekpath, names))
+            pending.put((key, havepath, installdir, seekpath, st,
+                         products, asyncres, None))
+
+    def walk():
+        try:
+            walk_parallel(rootpath, jobs, visit)
+        except Exception:
+            errors.append(sys.exc_info())
+        pending.put(None)
+
+    walkthread = threading.Thread(target=walk)
+    walkthread.setDaemon(True)
+
+    try:
+        walkthread.start()
+        while True:
+            item = pending.get()
+            if item is None:
+                break
+
+            (key, havepath, installdir, seekpath, st, products, asyncres,
+             result) = item
+            if asyncres is not None:
+                (result, snapshot) = asyncres.get()
+                if snapshot is not None:
+                    stats.merge(snapshot)
+                if result is not None:
+                    (name, status, got_version) = result
+                    result = (index.byname[name], status, got_version)
+                if cache is not None:
+                    store_result(cache, havepath, seekpath, st, products,
+                                 result)
+
+            if result is None:
+                continue
+
+            (product, status, got_version) = result
+            yield (key, (installdir, product, status, got_version))
+
+        if errors:
+            (exctype, excvalue, exctb) = errors[0]
+            raise exctype, excvalue, exctb
+
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+
+    pool.join()
+
+def _iter_pipeline(rootpath, threads, index, cache, pruner):
+    """
+    The analyze_dir scanning loop for trees on network filesystems, 
+    where listing a directory or reading a file means waiting for the
+    server, but not for our CPU. The tree is listed by "threads" walker
+    threads, which also find the files worth analyzing, and another
+    "threads" threads read them ahead, so that many requests are out at
+    once. The regexes run here, as the contents come in, and findings 
+    are yielded in the order the files were found.
+
+    Every stage waits for the next one if it gets too far ahead, so no
+    more than a few files per thread are read and waiting at any time.
+
+    @rtype: generator
+    """
+    from multiprocessing.pool import ThreadPool
+    import Queue
+
+    readers = ThreadPool(threads)
+
+    # files found by the walkers, being read or waiting to be analyzed
+    pending = Queue.Queue(threads * 4)
+    errors  = []
+
+    def visit(root, dirs, files):
+        for candidate in _candidates(rootpath, root, dirs, files, index,
+                                     cache, pruner):
+            (key, havepath, installdir, seekpath, st, products, 
+             result) = candidate
+            asyncres = None
+            if result is False:
+                asyncres = readers.apply_async(read_file, 
+                        (havepath, products, False, st))
+            pending.put((key, havepath, installdir, seekpath, st, products, 
+                         asyncres, result))
+
+    def walk():
+        try:
+            walk_parallel(rootpath, threads, visit)
+        except Exception:
+            errors.append(sys.exc_info())
+        pending.put(None)
+
+    walkthread = threading.Thread(target=walk)
+    walkthread.setDaemon(True)
+
+    try:
+        walkthread.start()
+        while True:
+            item = pending.get()
+            if item is None:
+                break
+
+            (key, havepath, installdir, seekpath, st, products, asyncres,
+             result) = item
+            if asyncres is not None:
+                (contents, readfor) = asyncres.get()
+                result = None
+                if contents is not None:
+                    result = analyze_contents(installdir, contents, readfor)
+                if cache is not None:
+                    store_result(cache, havepath, seekpath, st, products,
+                                 result)
+
+            if result is None:
+                continue
+
+            (product, status, got_version) = result
+            yield (key, (installdir, product, status, got_version))
+
+        if errors:
+            (exctype, excvalue, exctb) = errors[0]
+            raise exctype, excvalue, exctb
+
+        readers.close()
+    except:
+        readers.terminate()
+        raise
+
+    readers.join()
+
+class PollWatcher:
+    """
+    Notices when files matching crud.ini paths are added or changed
+    under a path, by checking the mtimes of all the directories we walk
+    into, and the inode, size and mtime of all the matching files, every
+    time it is asked. Only the directories that changed are listed again.
+
+    Directories the Pruner says not to walk into are not watched.
+    """
+
+    def __init__(self, rootpath, index, pruner):
+        """
+        @param rootpath: the path to watch
+        @type  rootpath: str
+        @param index: the products we are looking for
+        @type  index: SeekIndex
+        @param pruner: what not to walk into
+        @type  pruner: Pruner
+        """
+        self.rootpath = rootpath
+        self.index    = index
+        self.pruner   = pruner
+        #: directory: mtime (or watch descriptor, see InotifyWatcher)
+        self.dirs     = {}
+        #: file: (inode, size, mtime)
+        self.files    = {}
+
+        self.add_tree(rootpath)
+
+    def add_tree(self, path):
+        """
+        Start watching a directory and everything below it.
+
+        @param path: the directory
+        @type  path: str
+
+        @return: the files matching crud.ini paths found in it
+        @rtype: list
+        """
+        found = []
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            self.pruner.prune(root, dirs, files)
+            try:
+                self.add_dir(root)
+            except OSError, ex:
+                if ex.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    # e.g. out of inotify watches: don't just leave the
+                    # directory unwatched, let the caller poll instead
+                    raise
+                # it's gone already
+                del dirs[:]
+                continue
+            for filename in sorted(files):
+                havepath = os.path.join(root, filename)
+                if self.is_candidate(havepath):
+                    self.files[havepath] = self._stat(havepath)
+                    found.append(havepath)
+
+        return found
+
+    def add_dir(self, path):
+        """
+        Start watching one directory.
+
+        @raise OSError: if it is gone, or we could not watch it
+        @rtype: void
+        """
+        self.dirs[path] = os.stat(path).st_mtime
+
+    def close(self):
+        """
+        Stop watching.
+
+        @rtype: void
+        """
+        pass
+
+    def is_candidate(self, havepath):
+        """
+        Whether the file matches any of the crud.ini paths.
+
+        @rtype: boolean
+        """
+        if not self.index.has_file(os.path.basename(havepath)):
+            return False
+
+        return len(self.index.match(havepath)) > 0
+
+    def changes(self, timeout):
+        """
+        Wait for the timeout, and find what changed since the last call.
+
+        @param timeout: how long to wait, in seconds
+        @type  timeout: float
+
+        @return: files matching crud.ini paths that were added or changed
+        @rtype: list
+        """
+        time.sleep(timeout)
+
+        changed = []
+        for (path, mtime) in self.dirs.items():
+            try:
+                st = os.stat(path)
+            except OSError:
+                del self.dirs[path]
+                continue
+            if st.st_mtime == mtime:
+                continue
+
+            # something was added, removed or renamed in there
+            self.dirs[path] = st.st_mtime
+            try:
+                names = sorted(os.listdir(path))
+            except OSError:
+                continue
+
+            dirs  = []
+            files = []
+            for name in names:
+                if os.path.isdir(os.path.join(path, name)):
+                    dirs.append(name)
+                else:
+                    files.append(name)
+
+            self.pruner.prune(path, dirs, files)
+            for name in dirs:
+                if os.path.join(path, name) not in self.dirs:
+                    changed.extend(self.add_tree(os.path.join(path, name)))
+
+            for name in files:
+                havepath = os.path.join(path, name)
+                if havepath not in self.files and self.is_candidate(havepath):
+                    self.files[havepath] = self._stat(havepath)
+                    changed.append(havepath)
+
+        for (havepath, signature) in self.files.items():
+            newsignature = self._stat(havepath)
+            if newsignature is None:
+                del self.files[havepath]
+            elif newsignature != signature:
+                self.files[havepath] = newsignature
+                changed.append(havepath)
+
+        return changed
+
+    def _stat(self, havepath):
+        """
+        @return: (inode, size, mtime), or None if the file is gone
+        @rtype: tuple
+        """
+        try:
+            st = os.stat(havepath)
+        except OSError:
+            return None
+
+        return (st.st_ino, st.st_size, st.st_mtime)
+
+#: inotify event flags, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_ISDIR       = 0x40000000
+
+class InotifyWatcher(PollWatcher):
+    """
+    Same as PollWatcher, but the kernel tells us what changed, so we
+    don't need to go looking for it. Only works on Linux, and every
+    watched directory uses up one of the user's inotify watches (see
+    /proc/sys/fs/inotify/max_user_watches).
+    """
+
+    def __init__(self, rootpath, index, pruner):
+        """
+        @raise OSError: if we could not set up inotify (e.g. not enough
+                        watches)
+        @raise AttributeError: if libc does not have inotify
+        """
+        import ctypes, ctypes.util
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), 
+                                use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        #: watch descriptor: directory
+        self.wds = {}
+
+        try:
+            PollWatcher.__init__(self, rootpath, index, pruner)
+        except:
+            os.close(self.fd)
+            raise
+
+    def add_dir(self, path):
+        """
+        Start watching one directory.
+
+        @rtype: void
+        """
+        import ctypes
+
+        mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | \
+               IN_ONLYDIR
+        wd = self.libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, '%s: %s' % (path, os.strerror(err)))
+
+        self.wds[wd] = path
+        self.dirs[path] = wd
+
+    def close(self):
+        """
+        Stop watching, and give the watches back.
+
+        @rtype: void
+        """
+        os.close(self.fd)
+
+    def forget(self, path):
+        """
+        Stop watching a directory and everything below it, e.g. because
+        it was moved somewhere else.
+
+        @rtype: void
+        """
+        prefix = os.path.join(path, '')
+        for (dirpath, wd) in self.dirs.items():
+            if dirpath == path or dirpath.startswith(prefix):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.dirs[dirpath]
+                del self.wds[wd]
+
+    def changes(self, timeout):
+        """
+        Wait up to the timeout for something to change.
+
+        @param timeout: how long to wait, in seconds
+        @type  timeout: float
+
+        @return: files matching crud.ini paths that were added or changed
+        @rtype: list
+        """
+        import select, struct
+
+        (readable, writable, failed) = select.select([self.fd], [], [], 
+                                                     timeout)
+        if not readable:
+            return []
+
+        data = os.read(self.fd, 65536)
+
+        changed = []
+        offset  = 0
+        while offset < len(data):
+            (wd, mask, cookie, length) = struct.unpack_from('iIII', data, 
+                                                            offset)
+            offset += struct.calcsize('iIII')
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # we missed some events, so look at everything again
+                changed.extend(self.add_tree(self.rootpath))
+                continue
+
+            if wd not in self.wds:
+                continue
+
+            if mask & IN_IGNORED:
+                # the directory is gone
+                del self.dirs[self.wds.pop(wd)]
+                continue
+
+            path     = self.wds[wd]
+            havepath = os.path.join(path, name)
+
+            if mask & IN_ISDIR:
+                if mask & IN_MOVED_FROM:
+                    self.forget(havepath)
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    dirs = [name]
+                    self.pruner.prune(path, dirs, [])
+                    if dirs:
+                        changed.extend(self.add_tree(havepath))
+
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                if self.is_candidate(havepath):
+                    changed.append(havepath)
+
+        # the same file may have been written more than once
+        seen = set()
+        unique = []
+        for havepath in changed:
+            if havepath not in seen:
+                seen.add(havepath)
+                unique.append(havepath)
+
+        return unique
+
+def watch_dir(rootpath, crudfile, quiet, wantenv=[], jobs=1, cachefile=None,
+              full=False, prunedirs=[], maxdepth=0, crudcache=None, 
+              shard=None, interval=WATCHINTERVAL, poll=False, iothreads=0):
+    """
+    Scan the path with analyze_dir, then keep watching it, analyzing
+    files matching crud.ini paths as soon as they are added or changed.
+    Uses inotify if it can, and polls for changes otherwise, including
+    when inotify runs out of watches later on.
+
+    The arguments are the same as for analyze_dir, plus:
+
+    @param interval: how often to poll for changes, in seconds (also how
+                     often to yield when nothing changes)
+    @type  interval: float
+    @param poll: poll for changes, even if inotify is available
+    @type  poll: boolean
+
+    @return: generator of Reports, like analyze_dir returns them: first
+             all the findings of the initial scan, then the findings in
+             the files that changed, every time something changes or
+             "interval" seconds pass (empty if nothing was found). It 
+             never stops.
+    @rtype: generator
+    """
+    (index, crudsum) = load_crud(crudfile, wantenv, crudcache)
+    pruner = Pruner(rootpath, index, index.prunedirs + list(prunedirs),
+                    maxdepth or index.maxdepth, shard)
+
+    # start watching before the scan, so nothing that changes 
+    # while it runs is missed
+    watcher = None
+    if not poll:
+        try:
+            watcher = InotifyWatcher(rootpath, index, pruner)
+        except (AttributeError, OSError), ex:
+            if not quiet:
+                print 'Could not use inotify (%s), polling for changes' % ex
+    if watcher is None:
+        watcher = PollWatcher(rootpath, index, pruner)
+
+    yield analyze_dir(rootpath, crudfile, quiet, wantenv, jobs, cachefile,
+                      full, prunedirs, maxdepth, crudcache, shard, iothreads)
+
+    while True:
+        found = Report()
+        try:
+            changed = watcher.changes(interval)
+        except OSError, ex:
+            if not isinstance(watcher, InotifyWatcher):
+                raise
+            if not quiet:
+                print 'Could not use inotify any more (%s), polling for ' \
+                      'changes' % ex
+            watcher.close()
+            # we don't know what we missed, so look at everything again
+            watcher = PollWatcher(rootpath, index, pruner)
+            changed = sorted(watcher.files.keys())
+
+        for havepath in changed:
+            for seekpath in index.match(havepath):
+                installdir = havepath[:-len(seekpath)]
+                products = andpath_products(index.products[seekpath],
+                                            installdir)
+                if not products:
+                    continue
+                try:
+                    result = analyze_file(havepath, installdir, products)
+                except (IOError, OSError):
+                    # it's gone already
+                    continue
+                if result is None:
+                    continue
+
+                (product, status, got_version) = result
+                if status == 'vulnerable' and not quiet:
+                    print "[%s] %s found, %s wanted, in %s" % (
+                            product.name, got_version, 
+                            product.secure, installdir)
+
+                found.add(installdir, product, status, got_version)
+
+        yield found
+
+def loadmailmap(mailmapini):
+    """
+    Load mailmap.ini file and return the dict with contents.
+    
+    @param mailmapini: path with mailmap.ini
+    @type  mailmapini: string
+
+    @return: dict in the following format:
+             {
+                 '/some/path': {
+                    'fqdn':   'foobar.baz', 
+                    'admins': ['eml1', 'eml2']
+                 },
+                 ...
+             }
+    @rtype dict
+    """
+
+    conf = ConfigParser()
+    conf.read(mailmapini)
+
+    mailmap = {}
+
+    for fqdn in conf.sections():
+        path = conf.get(fqdn, 'path')
+        path = os.path.normpath(path) + '/'
+
+        admins = comma2array(conf.get(fqdn, 'email'))
+
+        mailmap[path] = {'fqdn': fqdn, 'admins': admins}
+
+    return mailmap
+
+class MailMapIndex:
+    """
+    Finds which site in the mailmap an install dir belongs to. Plain
+    paths are kept in a trie of path components, so a lookup only costs
+    as much as the depth of the install dir. Paths containing glob 
+    characters are matched with fnmatch, like before.
+
+    If several paths match, the longest one wins, so a site inside 
+    another site's directory gets its own nags.
+    """
+
+    def __init__(self, mailmap):
+        """
+        @param mailmap: the mailmap, as returned by loadmailmap
+        @type  mailmap: dict
+        """
+        #: the trie: {component: {component: ..., None: path}}
+        self.tree  = {}
+        #: paths with globs in them, longest first
+        self.globs = []
+
+        for path in mailmap.keys():
+            if re.search('[*?[]', path):
+                self.globs.append(path)
+                continue
+
+            node = self.tree
+            for chunk in path.split('/'):
+                if chunk:
+                    node = node.setdefault(chunk, {})
+            node[None] = path
+
+        self.globs.sort(key=lambda path: (-len(path), path))
+
+    def lookup(self, installdir):
+        """
+        Find the mailmap path for this install dir.
+
+        @param installdir: normalized install dir, ending with a "/"
+        @type  installdir: str
+
+        @return: the mailmap path, or None if it's not in the mailmap
+        @rtype: str
+        """
+        found = self.tree.get(None)
+        node  = self.tree
+        for chunk in installdir.split('/'):
+            if not chunk:
+                continue
+            node = node.get(chunk)
+            if node is None:
+                break
+            if None in node:
+                found = node[None]
+
+        for path in self.globs:
+            if found is not None and len(path) <= len(found):
+                # can't beat what we already have
+                break
+            if stats.enabled:
+                stats.count('fnmatch_calls')
+            if fnmatch(installdir, path + '*'):
+                return path
+
+        return found
+
+def undot(template):
+    """
+    Take the lonely "." lines out of a mail template. They are only
+    there to keep ConfigParser from eating the blank lines.
+
+    @param template: the template, as it is in mailopts.ini
+    @type  template: str
+
+    @rtype: str
+    """
+    return dotremove.sub('', template)
+
+class NagTemplates:
+    """
+    The [nagmail] templates from mailopts.ini, made ready once per run
+    instead of once per message or finding: the lonely "." lines are 
+    taken out of the templates instead of the messages, and the lines
+    describing a finding are put together into one template for each
+    combination of lines a product needs, so that describing a finding
+    takes one string formatting.
+    """
+
+    def __init__(self, mailini):
+        """
+        @param mailini: the contents of mailopts.ini
+        @type  mailini: RawConfigParser
+        """
+        self.subject     = mailini.get('nagmail', 'subject')
+        self.mailfrom    = mailini.get('nagmail', 'from')
+        self.mailcc      = comma2array(mailini.get('nagmail', 'cc'))
+        self.greeting    = undot(mailini.get('nagmail', 'greeting'))
+        self.daysleft    = undot(mailini.get('nagmail', 'daysleft'))
+        self.productline = undot(mailini.get('nagmail', 'productline'))
+        self.hasupdate   = undot(mailini.get('nagmail', 'hasupdate'))
+        self.noupdate    = undot(mailini.get('nagmail', 'noupdate'))
+        self.hascomment  = undot(mailini.get('nagmail', 'hascomment'))
+        self.hasinfourl  = undot(mailini.get('nagmail', 'hasinfourl'))
+        self.closing     = undot(mailini.get('nagmail', 'closing'))
+
+        #: (has update, has comment, has infourl): finding template
+        self._entries = {}
+
+    def entry(self, product):
+        """
+        Get the template describing a finding of the product, ending 
+        with a newline.
+
+        @param product: the product found
+        @type  product: CrudProduct
 
-def nagowners(naglist, smtp, quiet):
+        @rtype: str
+        """
+        key = (product.secure != 'none', bool(product.comment),
+               bool(product.infourl))
+        template = self._entries.get(key)
+        if template is not None:
+            return template
+
+        (hasupdate, hascomment, hasinfourl) = key
+        parts = [self.productline, '\n']
+        if hasupdate:
+            parts.append(self.hasupdate)
+        else:
+            parts.append(self.noupdate)
+        parts.append('\n')
+        if hascomment:
+            parts += [self.hascomment, '\n']
+        if hasinfourl:
+            parts += [self.hasinfourl, '\n']
+
+        template = ''.join(parts)
+        self._entries[key] = template
+
+        return template
+
+def nagowners(naglist, mailer, quiet):
     """
-    Nags the owners of sites with insecure software.
+    Nags the owners of sites with insecure software. The greeting and
+    the rest of naglist come from NagTemplates, so the lonely "." lines
+    are already gone.
 
     @param naglist: dict with various bits related to nagging
     @type  naglist: dict
-    @param smtp: smtp object
-    @type  smtp: smtplib.SMTP
+    @param mailer: where to send the mail (anything with a sendmail method)
+    @type  mailer: Mailer
     @param quiet: whether to output anything to the console
     @type  quiet: boolean
     
     @rtype: void
     """
-    for sitename, nagdata in naglist.items():
-        body = nagdata['greeting']
-        body += '\n'
-        body += nagdata['daysleft']
-        body += '\n'
-
-        body += '\n'.join(nagdata['products'])
-        
-        body += nagdata['closing']
+    started = time.time()
 
-        # A hack to preserve linebreaks is to keep
-        # lonely "." on each line. 
-        body = dotremove.sub('', body)
+    for sitename, nagdata in naglist.items():
+        body = ''.join([nagdata['greeting'], '\n', nagdata['daysleft'], 
+                        '\n', '\n'.join(nagdata['products']), 
+                        nagdata['closing']])
 
         # send mail
         msg = MIMEText(body)
@@ -361,10 +3468,363 @@ def nagowners(naglist, smtp, quiet):
         if not quiet:
             print 'Nagging: %s' % msg['To']
 
+        mailer.sendmail(nagdata['mailfrom'], recipients, msg.as_string())
+
+    if stats.enabled:
+        stats.count('nag_messages', len(naglist))
+        stats.time('nagowners', started)
+
+class Mailer:
+    """
+    Sends mail through an outbox kept in the nagstate database. Messages
+    are only added to the outbox by sendmail(), and flush() then delivers
+    them over a small pool of SMTP connections, each reused for as many
+    messages as it can take. Messages that fail for temporary reasons are
+    retried with a growing delay, and whatever could still not be sent
+    stays in the outbox until the next run. If the mail host can't be
+    reached at all, the rest of the outbox is left for the next run 
+    without trying every message.
+    """
+
+    def __init__(self, sconn, mailhost, connections=1, retries=3, backoff=5,
+                 timeout=60):
+        """
+        @param sconn: connection to the nagstate database
+        @type  sconn: sqlite.Connection
+        @param mailhost: host to use for smtp connections
+        @type  mailhost: str
+        @param connections: how many smtp connections to use at once
+        @type  connections: int
+        @param retries: how many more times to try a message after a
+                        temporary failure
+        @type  retries: int
+        @param backoff: seconds to wait before the first retry (doubled
+                        with every retry after that)
+        @type  backoff: int
+        @param timeout: smtp connection timeout, in seconds
+        @type  timeout: int
+        """
+        self.sconn       = sconn
+        self.mailhost    = mailhost
+        self.connections = max(connections, 1)
+        self.retries     = retries
+        self.backoff     = backoff
+        self.timeout     = timeout
+
+    def sendmail(self, mailfrom, recipients, message):
+        """
+        Add a message to the outbox. Takes the same arguments as
+        smtplib.SMTP.sendmail, but nothing is sent until flush(), and
+        nothing is committed until then either, so the caller can save
+        the outbox together with its own changes.
+
+        @rtype: void
+        """
+        query = """
+            INSERT INTO outbox (mailfrom, recipients, message)
+                 VALUES (?, ?, ?)"""
+        self.sconn.cursor().execute(query, 
+                (mailfrom, COMMASPACE.join(recipients), message))
+
+    def flush(self, quiet=False):
+        """
+        Deliver everything in the outbox, including any messages left
+        over from the previous runs.
+
+        @param quiet: whether to output anything to the console
+        @type  quiet: boolean
+
+        @return: (sent, deferred) -- how many messages were delivered, 
+                 and how many are left in the outbox
+        @rtype: tuple
+        """
+        import Queue
+
+        started = time.time()
+        self.sconn.commit()
+        scursor = self.sconn.cursor()
+
+        query = """
+            SELECT message_id, mailfrom, recipients, message
+              FROM outbox
+          ORDER BY message_id"""
+        scursor.execute(query)
+        rows = scursor.fetchall()
+        if not rows:
+            return (0, 0)
+
+        outqueue = Queue.Queue()
+        for row in rows:
+            outqueue.put(row)
+
+        # list.append is atomic, so the workers can share this one
+        results = []
+        workers = []
+        for i in range(min(self.connections, len(rows))):
+            worker = threading.Thread(target=self._deliver, 
+                                      args=(outqueue, results))
+            worker.start()
+            workers.append(worker)
+
+        for worker in workers:
+            worker.join()
+
+        # the workers stop early if they can't connect, and leave the 
+        # rest of the messages in the outbox as they are
+        untried = outqueue.qsize()
+        if untried and not quiet:
+            print 'Could not connect to %s, %d more messages left in the ' \
+                  'outbox' % (self.mailhost, untried)
+
+        done     = []
+        deferred = []
+        sent     = 0
+        for (message_id, recipients, error, permanent) in results:
+            if error is None:
+                done.append((message_id,))
+                sent += 1
+            elif permanent:
+                print 'Sending mail to %s failed: %s' % (recipients, error)
+                done.append((message_id,))
+            else:
+                if not quiet:
+                    print 'Sending mail to %s deferred: %s' % (recipients, 
+                                                               error)
+                deferred.append((error, message_id))
+
+        query = "DELETE FROM outbox WHERE message_id = ?"
+        scursor.executemany(query, done)
+
+        query = """
+            UPDATE outbox
+               SET attempts   = attempts + 1,
+                   last_error = ?
+             WHERE message_id = ?"""
+        scursor.executemany(query, deferred)
+
+        self.sconn.commit()
+
+        if stats.enabled:
+            stats.count('mail_sent', sent)
+            stats.count('mail_deferred', len(deferred) + untried)
+            stats.time('mail_delivery', started)
+
+        return (sent, len(deferred) + untried)
+
+    def _deliver(self, outqueue, results):
+        """
+        Worker thread: send messages from the queue over one connection
+        until the queue is empty, or until we can't connect even after
+        retrying.
+
+        @rtype: void
+        """
+        import Queue
+
+        smtp = None
+        while True:
+            try:
+                (message_id, mailfrom, recipients, message) = \
+                        outqueue.get_nowait()
+            except Queue.Empty:
+                break
+
+            attempt = 0
+            while True:
+                error      = None
+                permanent  = False
+                connecting = False
+                try:
+                    if smtp is None:
+                        connecting = True
+                        smtp = smtplib.SMTP(self.mailhost, 
+                                            timeout=self.timeout)
+                        connecting = False
+                    smtp.sendmail(mailfrom, comma2array(recipients), message)
+                except smtplib.SMTPRecipientsRefused, ex:
+                    # permanent if no recipient got a temporary error
+                    error = ex.recipients
+                    permanent = True
+                    for (code, resp) in ex.recipients.values():
+                        if code < 500:
+                            permanent = False
+                except smtplib.SMTPResponseException, ex:
+                    error = '%s %s' % (ex.smtp_code, ex.smtp_error)
+                    permanent = ex.smtp_code >= 500
+                except (smtplib.SMTPException, socket.error), ex:
+                    # start over with a new connection
+                    error = ex
+                    if smtp is not None:
+                        try:
+                            smtp.close()
+                        except:
+                            pass
+                    smtp = None
+
+                if connecting:
+                    # not the message's fault, whatever the server said
+                    permanent = False
+
+                if error is None or permanent or attempt >= self.retries:
+                    break
+
+                time.sleep(self.backoff * 2 ** attempt)
+                attempt += 1
+
+            if error is not None:
+                error = str(error)
+            results.append((message_id, recipients, error, permanent))
+
+            if connecting:
+                # the rest would only wait for the same thing, so leave
+                # them for the next run
+                break
+
+        if smtp is not None:
+            try:
+                smtp.quit()
+            except:
+                pass
+
+def write_csv(findings, csvfile, repsec):
+    """
+    Write the findings into a CSV report as they come in, passing them
+    on to whoever wants them next.
+
+    @param findings: iterable of (installdir, product, status, got_version)
+    @type  findings: iterable
+    @param csvfile: where to save the report
+    @type  csvfile: str
+    @param repsec: whether to also include secure versions
+    @type  repsec: boolean
+
+    @return: generator of the same findings
+    @rtype: generator
+    """
+    import csv
+    out = open(csvfile, 'w')
+    writer = csv.writer(out, quoting=csv.QUOTE_ALL)
+    writer.writerow(('path', 'product', 'found', 'secure', 'status',
+                     'comment', 'more info'))
+
+    for finding in findings:
+        (installdir, product, status, got_version) = finding
+        if status != 'secure' or repsec:
+            writer.writerow((installdir, product.name, got_version,
+                             product.secure, status, product.comment,
+                             product.infourl))
+            out.flush()
+
+        yield finding
+
+    out.close()
+
+def write_results(findings, resultsfile, shard=None):
+    """
+    Save the findings into a results file as they come in, passing them
+    on to whoever wants them next. Results files from several hosts (or
+    shards) can be combined with read_results, so that one host can do
+    the reporting and nagging for all of them.
+
+    The file is gzipped, with a header line followed by one line per
+    finding, all in JSON. Products are saved by name, so they can be
+    looked up again in crud.ini. It is only put in place once all the
+    findings are in, so nobody reads a half-written file.
+
+    @param findings: iterable of (installdir, product, status, got_version)
+    @type  findings: iterable
+    @param resultsfile: where to save the results
+    @type  resultsfile: str
+    @param shard: (k, n) if these are the results of one shard
+    @type  shard: tuple
+
+    @return: generator of the same findings
+    @rtype: generator
+    """
+    import gzip, json
+
+    header = {
+            'format':  'crudminer-results',
+            'version': RESULTSVERSION,
+            'shard':   shard,
+            'crudminerversion': VERSION,
+            }
+
+    fh = AtomicFile(resultsfile, 'wb')
+    out = gzip.GzipFile(resultsfile, 'wb', fileobj=fh)
+    out.write(json.dumps(header) + '\n')
+
+    for finding in findings:
+        (installdir, product, status, got_version) = finding
+        # paths are bytes and may not be valid utf-8, and latin-1
+        # gets any bytes there and back unchanged
+        out.write(json.dumps((installdir, product.name, status, 
+                              got_version), encoding='latin-1') + '\n')
+
+        yield finding
+
+    out.close()
+    fh.close()
+
+def read_results(resultsfiles, index):
+    """
+    Read the findings back from results files saved by write_results,
+    e.g. by the hosts scanning different shards.
+
+    Product names are looked up in the index, and the status of every 
+    finding is worked out again from the secure version in our crud.ini,
+    so findings are reported the same way no matter which host found
+    them. Findings that are in several files are only returned once, 
+    so they are all kept in a Report and returned once all the files
+    are read.
+
+    @param resultsfiles: results files to read
+    @type  resultsfiles: list
+    @param index: the products we know about
+    @type  index: SeekIndex
+
+    @return: generator of (installdir, product, status, got_version)
+    @rtype: generator
+    """
+    import gzip, json
+
+    report  = Report(unique=True)
+    unknown = set()
+    for resultsfile in resultsfiles:
+        fh = gzip.open(resultsfile, 'rb')
         try:
-            smtp.sendmail(nagdata['mailfrom'], recipients, msg.as_string())
-        except smtplib.SMTPRecipientsRefused, ex:
-            print 'Nagging failed: %s' % ex
+            header = json.loads(fh.readline())
+        except (IOError, ValueError):
+            header = None
+        if (not isinstance(header, dict) 
+                or header.get('format') != 'crudminer-results'
+                or header.get('version') != RESULTSVERSION):
+            fh.close()
+            raise ValueError('%s is not a crudminer results file' 
+                             % resultsfile)
+
+        for line in fh:
+            (installdir, name, status, got_version) = [
+                    field.encode('latin-1') for field in json.loads(line)]
+
+            product = index.byname.get(name)
+            if product is None:
+                if name not in unknown:
+                    print >> sys.stderr, 'Skipping %s: no such product ' \
+                          'in crud.ini' % name
+                    unknown.add(name)
+                continue
+
+            status = 'vulnerable'
+            if product.is_secure(got_version):
+                status = 'secure'
+
+            report.add(installdir, product, status, got_version)
+
+        fh.close()
+
+    for finding in report:
+        yield finding
 
 def comma2array(commastr):
     """
@@ -381,6 +3841,24 @@ def comma2array(commastr):
         entries.append(entry.strip())
     return entries
 
+#: mail waiting to be delivered, kept in the nagstate database
+OUTBOXTABLE = """CREATE TABLE outbox (
+                        message_id  INTEGER PRIMARY KEY,
+                        mailfrom    TEXT,
+                        recipients  TEXT,
+                        message     TEXT,
+                        queued_date DATE DEFAULT CURRENT_DATE,
+                        attempts    INTEGER DEFAULT 0,
+                        last_error  TEXT DEFAULT NULL)"""
+
+#: Indexes for the "state" queries, which look for findings by date
+STATEINDEXES = [
+    "CREATE INDEX nagstate_found_date ON nagstate (found_date)",
+    "CREATE INDEX nagstate_nag_date ON nagstate (nag_date)",
+    """CREATE INDEX nagstate_do_not_nag_until 
+           ON nagstate (do_not_nag_until)""",
+    ]
+
 def nagstate_connect(statedb):
     """
     Helper function to establish a connection to the nagstate database,
@@ -405,6 +3883,16 @@ def nagstate_connect(statedb):
                           do_not_nag_until DATE DEFAULT NULL)"""
         scursor.execute(query)
 
+        query = """CREATE INDEX nagstate_finding
+                       ON nagstate (installed_dir, product_name, 
+                                    found_version)"""
+        scursor.execute(query)
+
+        for query in STATEINDEXES:
+            scursor.execute(query)
+
+        scursor.execute(OUTBOXTABLE)
+
         query = """CREATE TABLE meta (
                           dbversion INTEGER
                           )"""
@@ -451,8 +3939,612 @@ def nagstate_connect(statedb):
 
             dbversion = 2
 
+        if dbversion == 2:
+            # Add the index for looking up findings
+            query = """CREATE INDEX nagstate_finding
+                           ON nagstate (installed_dir, product_name, 
+                                        found_version)"""
+            scursor.execute(query)
+            query = "UPDATE meta SET dbversion = 3"
+            scursor.execute(query)
+
+            sconn.commit()
+
+            dbversion = 3
+
+        if dbversion == 3:
+            # Add the outbox for mail we could not deliver yet
+            scursor.execute(OUTBOXTABLE)
+            query = "UPDATE meta SET dbversion = 4"
+            scursor.execute(query)
+
+            sconn.commit()
+
+            dbversion = 4
+
+        if dbversion == 4:
+            # Add the indexes for the "state" command
+            for query in STATEINDEXES:
+                scursor.execute(query)
+            query = "UPDATE meta SET dbversion = 5"
+            scursor.execute(query)
+
+            sconn.commit()
+
+            dbversion = 5
+
+    # paths are whatever bytes the filesystem gave us, and so is the
+    # mail that mentions them: they go in and come back out as such
+    sconn.text_factory = str
+
     return sconn
 
+class NagState:
+    """
+    In-memory copy of the nagstate table. All of it is loaded at once
+    when we start, and all the changes made during the run are written
+    back in one transaction by save(), instead of running several 
+    queries for every finding.
+    """
+
+    def __init__(self, statedb):
+        """
+        @param statedb: the location of the nagstate database
+        @type  statedb: str
+        """
+        started = time.time()
+
+        self.sconn = nagstate_connect(statedb)
+        scursor = self.sconn.cursor()
+
+        # use sqlite's idea of the current date, same as the table defaults
+        scursor.execute("SELECT CURRENT_DATE")
+        (self.today,) = scursor.fetchone()
+
+        #: (installed_dir, product_name, found_version): 
+        #:      [found_date, nag_date, do_not_nag_until]
+        self.rows = {}
+        query = """
+            SELECT installed_dir, product_name, found_version,
+                   found_date, nag_date, do_not_nag_until
+              FROM nagstate"""
+        scursor.execute(query)
+        for row in scursor.fetchall():
+            self.rows[tuple(row[:3])] = list(row[3:])
+
+        if stats.enabled:
+            stats.time('nagstate_load', started)
+
+        #: keys of new findings, to be inserted
+        self.inserted = []
+        #: keys of findings we nagged about
+        self.nagged   = []
+        #: (do_not_nag_until, key) of findings we were asked to snooze
+        self.snoozed  = []
+
+    def lookup(self, installdir, product_name, found_version):
+        """
+        Find the state of a finding, adding it if it is new.
+
+        @return: (isnew, [found_date, nag_date, do_not_nag_until])
+        @rtype: tuple
+        """
+        key = (installdir, product_name, found_version)
+        row = self.rows.get(key)
+        if row is not None:
+            return (0, row)
+
+        # this is a new discovery
+        row = [self.today, self.today, None]
+        self.rows[key] = row
+        self.inserted.append(key)
+
+        return (1, row)
+
+    def nag(self, installdir, product_name, found_version):
+        """
+        Record that we nagged about a finding today.
+
+        @rtype: void
+        """
+        key = (installdir, product_name, found_version)
+        self.rows[key][1] = self.today
+        self.nagged.append(key)
+
+    def snooze(self, installdir, product_name, found_version, until):
+        """
+        Record that we should not nag about a finding until the date.
+
+        @param until: date in YYYY-MM-DD format
+        @type  until: str
+
+        @rtype: void
+        """
+        key = (installdir, product_name, found_version)
+        self.rows[key][2] = until
+        self.snoozed.append((until,) + key)
+
+    def save(self):
+        """
+        Write all the changes to the database in one transaction.
+
+        @rtype: void
+        """
+        started = time.time()
+        scursor = self.sconn.cursor()
+
+        query = """
+            INSERT INTO nagstate
+                        (installed_dir, product_name, found_version)
+                 VALUES (?, ?, ?)"""
+        scursor.executemany(query, self.inserted)
+
+        query = """
+            UPDATE nagstate
+               SET nag_date = CURRENT_DATE
+             WHERE installed_dir = ?
+               AND product_name  = ?
+               AND found_version = ?"""
+        scursor.executemany(query, self.nagged)
+
+        query = """
+            UPDATE nagstate
+               SET do_not_nag_until = ?
+             WHERE installed_dir = ?
+               AND product_name  = ?
+               AND found_version = ?"""
+        scursor.executemany(query, self.snoozed)
+
+        self.sconn.commit()
+
+        if stats.enabled:
+            stats.time('nagstate_save', started)
+
+        self.inserted = []
+        self.nagged   = []
+        self.snoozed  = []
+
+def state_list(sconn, prefix=None, product_name=None):
+    """
+    List the findings in the nagstate database, as of the last time we
+    nagged about them.
+
+    @param sconn: connection to the nagstate database
+    @type  sconn: sqlite.Connection
+    @param prefix: only list the findings in install dirs starting with
+                   this (None: all of them)
+    @type  prefix: str
+    @param product_name: only list the findings of this product
+    @type  product_name: str
+
+    @return: list of (installed_dir, product_name, found_version, 
+                      found_date, nag_date, do_not_nag_until)
+    @rtype: list
+    """
+    (where, params) = _state_where(prefix, product_name)
+
+    query = """
+        SELECT installed_dir, product_name, found_version,
+               found_date, nag_date, do_not_nag_until
+          FROM nagstate
+         WHERE %s
+      ORDER BY installed_dir, product_name, found_version""" % where
+    scursor = sconn.cursor()
+    scursor.execute(query, params)
+
+    return scursor.fetchall()
+
+def state_overdue(sconn, nagdays):
+    """
+    List the findings that were found more than nagdays ago, so their
+    owners are out of time, unless we were asked not to nag about them.
+    The oldest ones come first.
+
+    @param sconn: connection to the nagstate database
+    @type  sconn: sqlite.Connection
+    @param nagdays: how many days owners have to fix things
+    @type  nagdays: int
+
+    @return: same as state_list
+    @rtype: list
+    """
+    query = """
+        SELECT installed_dir, product_name, found_version,
+               found_date, nag_date, do_not_nag_until
+          FROM nagstate
+         WHERE found_date < date('now', ?)
+           AND (do_not_nag_until IS NULL 
+                OR do_not_nag_until <= CURRENT_DATE)
+      ORDER BY found_date, installed_dir"""
+    scursor = sconn.cursor()
+    scursor.execute(query, ('-%d days' % nagdays,))
+
+    return scursor.fetchall()
+
+def state_sites(sconn, mailmap, nagdays):
+    """
+    Count the findings of every site in the mailmap. Findings are 
+    counted up per install dir by sqlite, and the install dirs are then
+    added up per site.
+
+    @param sconn: connection to the nagstate database
+    @type  sconn: sqlite.Connection
+    @param mailmap: the mailmap, as returned by loadmailmap
+    @type  mailmap: dict
+    @param nagdays: how many days owners have to fix things
+    @type  nagdays: int
+
+    @return: list of (sitename, findings, overdue, snoozed, oldest), 
+             sorted by site name, where sitename is None for the install
+             dirs that are not in the mailmap, and oldest is the found
+             date of the oldest finding
+    @rtype: list
+    """
+    mailindex = MailMapIndex(mailmap)
+
+    query = """
+        SELECT installed_dir, 
+               COUNT(*),
+               SUM(found_date < date('now', ?)
+                   AND (do_not_nag_until IS NULL 
+                        OR do_not_nag_until <= CURRENT_DATE)),
+               SUM(IFNULL(do_not_nag_until > CURRENT_DATE, 0)),
+               MIN(found_date)
+          FROM nagstate
+      GROUP BY installed_dir"""
+    scursor = sconn.cursor()
+    scursor.execute(query, ('-%d days' % nagdays,))
+
+    sites = {}
+    for (installdir, findings, overdue, snoozed, oldest) in scursor:
+        sitename = None
+        path = mailindex.lookup(installdir)
+        if path is not None:
+            sitename = mailmap[path]['fqdn']
+
+        site = sites.get(sitename)
+        if site is None:
+            sites[sitename] = [sitename, findings, overdue, snoozed, oldest]
+            continue
+        site[1] += findings
+        site[2] += overdue
+        site[3] += snoozed
+        site[4] = min(site[4], oldest)
+
+    return sorted([tuple(site) for site in sites.values()])
+
+def state_snooze(sconn, until, prefix=None, product_name=None):
+    """
+    Stop nagging about findings until a date, all at once.
+
+    @param sconn: connection to the nagstate database
+    @type  sconn: sqlite.Connection
+    @param until: date in YYYY-MM-DD format
+    @type  until: str
+    @param prefix: only snooze the findings in install dirs starting 
+                   with this (None: all of them)
+    @type  prefix: str
+    @param product_name: only snooze the findings of this product
+    @type  product_name: str
+
+    @return: how many findings were snoozed
+    @rtype: int
+    """
+    (where, params) = _state_where(prefix, product_name)
+
+    query = """
+        UPDATE nagstate
+           SET do_not_nag_until = ?
+         WHERE %s""" % where
+    scursor = sconn.cursor()
+    scursor.execute(query, [until] + params)
+    sconn.commit()
+
+    return scursor.rowcount
+
+def _state_where(prefix, product_name):
+    """
+    Make the WHERE clause that picks findings for state_list and 
+    state_snooze.
+
+    @return: (where, params)
+    @rtype: tuple
+    """
+    where  = ['1']
+    params = []
+    if prefix is not None:
+        where.append('substr(installed_dir, 1, ?) = ?')
+        params += [len(prefix), prefix]
+    if product_name is not None:
+        where.append('product_name = ?')
+        params.append(product_name)
+
+    return (' AND '.join(where), params)
+
+def state_command(args, mailopts, quiet):
+    """
+    Run one of the "state" commands, which look at the nagstate database
+    without scanning anything:
+
+        list [path [product]]      list what we know about
+        overdue                    list what is past the nagdays deadline
+        sites                      count findings per site
+        snooze YYYY-MM-DD [path [product]]
+                                   stop nagging about them until then
+
+    @param args: the command and its arguments
+    @type  args: list
+    @param mailopts: location of mailopts.ini, to find the database
+    @type  mailopts: str
+    @param quiet: whether to output anything but what was asked for
+    @type  quiet: boolean
+
+    @rtype: void
+    """
+    mailini = RawConfigParser()
+    mailini.read(mailopts)
+
+    statedb = mailini.get('main', 'statedb')
+    nagdays = mailini.getint('main', 'nagdays')
+
+    sconn = nagstate_connect(statedb)
+    command = args[0]
+
+    if command in ('list', 'overdue'):
+        if command == 'list':
+            rows = state_list(sconn, *args[1:3])
+        else:
+            rows = state_overdue(sconn, nagdays)
+
+        for (installdir, product_name, found_version, found_date, nag_date,
+             do_not_nag_until) in rows:
+            line = '%s: %s v.%s, found %s, last nagged %s' % (
+                    installdir, product_name, found_version, found_date,
+                    nag_date)
+            if do_not_nag_until is not None:
+                line += ', not nagging until %s' % do_not_nag_until
+            print line
+
+    elif command == 'sites':
+        mailmap = loadmailmap(mailini.get('main', 'mailmap'))
+        for (sitename, findings, overdue, snoozed, oldest) in state_sites(
+                sconn, mailmap, nagdays):
+            if sitename is None:
+                sitename = '(not in mailmap)'
+            print '%s: %d found, %d overdue, %d snoozed, oldest from %s' % (
+                    sitename, findings, overdue, snoozed, oldest)
+
+    elif command == 'snooze':
+        count = state_snooze(sconn, *args[1:4])
+        if not quiet:
+            print 'Will not nag about %d finding(s) until %s' % (count, 
+                                                                  args[1])
+
+    sconn.close()
+
+def nag_findings(findings, mailopts, quiet, do_not_nag_until=None):
+    """
+    Record vulnerable findings in the nagstate database, and nag the
+    owners of the sites they were found on (or the hosting admins, once
+    the owners ran out of time).
+
+    @param findings: (installdir, product, status, got_version) tuples,
+                     like the Report returned by analyze_dir
+    @type  findings: iterable
+    @param mailopts: location of mailopts.ini
+    @type  mailopts: str
+    @param quiet: whether to output anything to the console
+    @type  quiet: boolean
+    @param do_not_nag_until: instead of nagging, stop nagging about these
+                             findings until this date (YYYY-MM-DD)
+    @type  do_not_nag_until: str
+
+    @rtype: void
+    """
+    # load mail options
+    mailini = RawConfigParser()
+    mailini.read(mailopts)
+
+    mailmap = loadmailmap(mailini.get('main', 'mailmap'))
+    mailindex = MailMapIndex(mailmap)
+
+    nagdays     = mailini.getint('main', 'nagdays')
+    nagfreq     = mailini.getint('main', 'nagfreq')
+    mailhost    = mailini.get('main', 'mailhost')
+    statedb     = mailini.get('main', 'statedb')
+    connections = 1
+    retries     = 3
+    backoff     = 5
+    if mailini.has_option('main', 'mailconnections'):
+        connections = mailini.getint('main', 'mailconnections')
+    if mailini.has_option('main', 'mailretries'):
+        retries = mailini.getint('main', 'mailretries')
+    if mailini.has_option('main', 'mailbackoff'):
+        backoff = mailini.getint('main', 'mailbackoff')
+    templates   = NagTemplates(mailini)
+
+    naglist = {}
+    offenders = {}
+
+    # filled in for every finding, instead of making a new one each time
+    values = {
+            'nagdays'         : nagdays,
+            'crudminerversion': VERSION
+            }
+
+    now  = time.localtime()
+    now_date = datetime.date(now[0], now[1], now[2])
+
+    nagstate = None
+
+    for (installdir, product, got_version) in nag_candidates(findings):
+        # is this path in our mailmap?
+        path = mailindex.lookup(installdir)
+        if path is None:
+            continue
+
+        # Do we have it in statedb?
+        if nagstate is None:
+            nagstate = NagState(statedb)
+
+        (isnew, row) = nagstate.lookup(installdir, product.name,
+                                       got_version)
+
+        (found_date, nag_date, snoozed_until) = row
+        # do they need to be nagged?
+
+        if snoozed_until is not None:
+            # we were asked not to nag them
+            until_date = sqlite2datetime(snoozed_until)
+            if now_date < until_date:
+                if not quiet:
+                    print "Not nagging about %s v.%s in %s until %s" % (
+                            product.name, got_version, installdir,
+                            until_date.isoformat())
+                continue
+
+        if do_not_nag_until:
+            # we were asked to stop nagging about this issue
+            nagstate.snooze(installdir, product.name, got_version,
+                            do_not_nag_until)
+            if not quiet:
+                print "Will no longer nag about %s v.%s in %s" % (
+                        product.name, got_version, installdir)
+            continue
+
+        nag_date   = sqlite2datetime(nag_date)
+        found_date = sqlite2datetime(found_date)
+
+        nagdiff = now_date - nag_date
+
+        if not isnew and nagdiff.days < nagfreq:
+            # they don't get nagged
+            continue
+
+        # update nag date
+        nagstate.nag(installdir, product.name, got_version)
+
+        founddiff = now_date - found_date
+
+        sitename = mailmap[path]['fqdn']
+
+        values['daysleft']      = nagdays - founddiff.days
+        values['sitename']      = sitename
+        values['productname']   = product.name
+        values['foundversion']  = got_version
+        values['installdir']    = installdir
+        values['secureversion'] = product.secure
+        values['comment']       = product.comment
+        values['infourl']       = product.infourl
+
+        if founddiff.days > nagdays:
+            # past nagging deadline, don't nag them any more,
+            # but keep nagging the hosting admins
+            if sitename not in offenders:
+                offenders[sitename] = {
+                        'admins':    mailmap[path]['admins'],
+                        'knowndays': founddiff.days,
+                        'products':  [],
+                        }
+            
+        else:
+            if sitename not in naglist:
+                if not isnew:
+                    mysubject = 'Re: %s' % templates.subject
+                else:
+                    mysubject = templates.subject
+
+                naglist[sitename] = {
+                        'admins'  : mailmap[path]['admins'],
+                        'mailfrom': templates.mailfrom,
+                        'mailcc'  : templates.mailcc,
+                        'subject' : mysubject % values,
+                        'greeting': templates.greeting % values,
+                        'daysleft': templates.daysleft % values,
+                        'products': [],
+                        'closing' : templates.closing % values
+                        }
+
+        # formulate product lines
+        entry = templates.entry(product) % values
+
+        if founddiff.days > nagdays:
+            offenders[sitename]['products'].append(entry)
+        else:
+            naglist[sitename]['products'].append(entry)
+
+    if nagstate is not None:
+        sconn = nagstate.sconn
+    elif os.path.exists(statedb):
+        # there may be mail left over from the previous run
+        sconn = nagstate_connect(statedb)
+    else:
+        sconn = None
+
+    if sconn is not None:
+        mailer = Mailer(sconn, mailhost, connections, retries, backoff)
+
+    if naglist:
+        nagowners(naglist, mailer, quiet)
+
+    if offenders:
+        # I know that I need to refactor this, considering
+        # nagowners is its own method.
+        subject   = mailini.get('nagreport', 'subject')
+        mailfrom  = mailini.get('nagreport', 'from')
+        greeting  = undot(mailini.get('nagreport', 'greeting'))
+        hostentry = undot(mailini.get('nagreport', 'hostentry'))
+        closing   = undot(mailini.get('nagreport', 'closing'))
+
+        mailto = comma2array(mailini.get('nagreport', 'to'))
+        mailcc = comma2array(mailini.get('nagreport', 'cc'))
+
+        values = {
+                'nagdays': nagdays,
+                'crudminerversion': VERSION
+                }
+
+        parts = [greeting % values, '\n']
+
+        for sitename, offdata in offenders.items():
+            values['admins'] = COMMASPACE.join(offdata['admins'])
+            values['sitename'] = sitename
+            values['knowndays'] = offdata['knowndays']
+
+            parts += [hostentry % values, '\n', 
+                      '\n'.join(offdata['products'])]
+    
+        parts.append(closing % values)
+        body = ''.join(parts)
+
+        # send mail
+        msg = MIMEText(body)
+
+        msg['From'] = mailfrom
+        msg['Subject'] = subject
+        msg['To'] = COMMASPACE.join(mailto)
+
+        recipients = mailto
+
+        if mailcc:
+            msg['Cc'] = COMMASPACE.join(mailcc)
+            recipients.extend(mailcc)
+
+        if not quiet:
+            print 'Sending an offender report to: %s' % msg['To']
+
+        mailer.sendmail(mailfrom, recipients, msg.as_string())
+
+    if nagstate is not None:
+        # this also saves the outbox
+        nagstate.save()
+
+    if sconn is not None:
+        (sent, deferred) = mailer.flush(quiet)
+        if deferred and not quiet:
+            print '%d message(s) left in the outbox for the next run' % \
+                    deferred
+
 def sqlite2datetime(sqlitedate):
     """
     Convert sqlite's date into a python datetime.
@@ -479,6 +4571,22 @@ def sqlite2datetime(sqlitedate):
 
     return rdate
 
+def write_stats(statsfile=None, promfile=None):
+    """
+    Save the stats collected so far, if asked to.
+
+    @param statsfile: where to save them as JSON ("-" for stdout)
+    @type  statsfile: str
+    @param promfile: where to save them in the Prometheus text format
+    @type  promfile: str
+
+    @rtype: void
+    """
+    if statsfile is not None:
+        stats.write_json(statsfile)
+    if promfile is not None:
+        stats.write_prometheus(promfile)
+
 def main():
     '''
     Main invocation.
@@ -489,7 +4597,33 @@ def main():
     from optparse     import OptionParser
 
     usage = '''usage: %prog [options] path
+       %prog [options] compile
+       %prog [options] merge resultsfile [resultsfile ...]
+       %prog [options] lint-signatures [fixturesdir]
+       %prog [options] state list [path [product]]
+       %prog [options] state overdue
+       %prog [options] state sites
+       %prog [options] state snooze YYYY-MM-DD [path [product]]
     This tool helps find unmaintained web software.
+
+    The "compile" command saves a parsed copy of crud.ini next to it,
+    which is used instead of crud.ini as long as crud.ini is unchanged.
+
+    The "merge" command reads the results saved with --save-results
+    (e.g. by several hosts, each scanning its own --shard), and makes
+    one report and does the nagging for all of them.
+
+    The "lint-signatures" command times the regex of every product in
+    crud.ini on the files in fixturesdir (e.g. tests/) and on made up
+    files that are hard on regexes, and lists the ones that go over
+    their budget.
+
+    The "state" commands look at what the nagging found so far, in the
+    statedb from --mailopts, without scanning anything: "list" lists
+    the findings (in install dirs starting with path, of product), 
+    "overdue" the ones past the nagdays deadline, "sites" counts them 
+    per site in the mailmap, and "snooze" stops nagging about them
+    until the date.
     '''
 
     parser = OptionParser(usage=usage, version='0.1')
@@ -498,7 +4632,7 @@ def main():
         help='Location of the crud.ini file (%default).')
     parser.add_option('-q', '--quiet', dest='quiet', action='store_true',
         default=False,
-        help='Do not output anything (usually with -r or -m).')
+        help='Only output warnings, on stderr (usually with -r or -m).')
     parser.add_option('-r', '--csv-report', dest='csv', default=None,
         help='Produce a CSV report and save it in a file.')
     parser.add_option('-s', '--report-secure', dest='repsec', 
@@ -508,9 +4642,61 @@ def main():
         default=[],
         help='Only analyze for these environments (php, perl, etc). \
               Default: all')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=1,
+        help='Walk and analyze in this many threads and processes \
+              (%default).')
+    parser.add_option('--io-threads', dest='iothreads', type='int', 
+        default=0,
+        help='List directories and read files in this many threads, \
+              for trees on network filesystems. Regexes still run in \
+              one process, so this replaces --jobs.')
+    parser.add_option('--cache', dest='cachefile', default=None,
+        help='Keep scan results in this file and only read files that \
+              changed since the previous run.')
+    parser.add_option('--full', dest='full', action='store_true',
+        default=False,
+        help='Ignore cached scan results and read every file.')
+    parser.add_option('--prune', dest='prunedirs', action='append',
+        default=[],
+        help='Do not walk into directories matching this glob, in \
+              addition to "prunedirs" from crud.ini. Can be repeated.')
+    parser.add_option('--max-depth', dest='maxdepth', type='int', default=0,
+        help='Walk at most this many levels below the path (default: \
+              "maxdepth" from crud.ini, or all the way).')
+    parser.add_option('--shard', dest='shard', default=None,
+        help='Only scan shard K of N (given as K/N) of the top-level \
+              directories in the path, e.g. to split the work between \
+              several hosts.')
+    parser.add_option('--save-results', dest='results', default=None,
+        help='Save all findings in this file, for the "merge" command.')
+    parser.add_option('--crudcache', dest='crudcache', default=CRUDCACHE,
+        help='When --crudfile is a URL, keep downloaded copies of it in \
+              this directory (%default).')
+    parser.add_option('--crudttl', dest='crudttl', type='int', 
+        default=CRUDTTL,
+        help='Use the downloaded crud.ini for this many seconds before \
+              checking for a new one (%default).')
+    parser.add_option('--watch', dest='watch', action='store_true',
+        default=False,
+        help='After scanning, keep running and analyze files as soon as \
+              they are added or changed, nagging about what is found.')
+    parser.add_option('--watch-interval', dest='interval', type='float',
+        default=WATCHINTERVAL,
+        help='With --watch, how often to poll for changes, in seconds \
+              (%default).')
+    parser.add_option('--watch-poll', dest='poll', action='store_true',
+        default=False,
+        help='With --watch, poll for changes even if inotify is available.')
+    parser.add_option('--stats', dest='stats', default=None,
+        help='Save counters and timings of what was done in this file, \
+              as JSON ("-" to print them).')
+    parser.add_option('--stats-prometheus', dest='promfile', default=None,
+        help='Save the same counters and timings in this file in the \
+              Prometheus text format (e.g. for the textfile collector).')
     parser.add_option('--mailopts', dest='mailopts',
         default=MAILOPTS,
-        help='Mail options to use when sending notifications.')
+        help='Mail options to use when sending notifications (%default). \
+              Set it to nothing to not send any.')
     parser.add_option('--do-not-nag-until', dest='do_not_nag_until',
         default=None,
         help='''Do not nag about anything found during this run until 
@@ -521,300 +4707,140 @@ def main():
     if not args:
         parser.error('You must specify a path where to mine for crud.')
 
-    rootpath = os.path.abspath(args[0])
-
-    report = analyze_dir(rootpath, opts.crudfile, opts.quiet, opts.env)
-
-    if opts.csv is not None:
-        import csv
-        out = open(opts.csv, 'w')
-        writer = csv.writer(out, quoting=csv.QUOTE_ALL)
-        writer.writerow(('path', 'product', 'found', 'secure', 'status',
-                         'comment', 'more info'))
-        
-        for (installdir, product, status, got_version) in report:
-            if  status == 'secure' and not opts.repsec:
-                continue
-
-            writer.writerow((installdir, product.name, got_version,
-                             product.secure, status, product.comment,
-                             product.infourl))
-
-        out.close()
-
+    if args[0] == 'compile':
+        if opts.crudfile.find('://') > -1:
+            parser.error('Can only compile a local crud.ini.')
+        bundlefile = compile_bundle(opts.crudfile)
         if not opts.quiet:
-            print 'CSV report saved in %s' % opts.csv
-    
-    if opts.mailopts is not None:
-        # load mail options
-        mailini = RawConfigParser()
-        mailini.read(opts.mailopts)
-
-        mailmap = loadmailmap(mailini.get('main', 'mailmap'))
-
-        nagdays     = mailini.getint('main', 'nagdays')
-        nagfreq     = mailini.getint('main', 'nagfreq')
-        mailhost    = mailini.get('main', 'mailhost')
-        statedb     = mailini.get('main', 'statedb')
-        subject     = mailini.get('nagmail', 'subject')
-        mailfrom    = mailini.get('nagmail', 'from')
-        mailcc      = comma2array(mailini.get('nagmail', 'cc'))
-        greeting    = mailini.get('nagmail', 'greeting')
-        daysleft    = mailini.get('nagmail', 'daysleft')
-        productline = mailini.get('nagmail', 'productline')
-        hasupdate   = mailini.get('nagmail', 'hasupdate')
-        noupdate    = mailini.get('nagmail', 'noupdate')
-        hascomment  = mailini.get('nagmail', 'hascomment')
-        hasinfourl  = mailini.get('nagmail', 'hasinfourl')
-        closing     = mailini.get('nagmail', 'closing')
-        
-        naglist = {}
-        offenders = {}
-
-        now  = time.localtime()
-        now_date = datetime.date(now[0], now[1], now[2])
+            print 'Compiled %s into %s' % (opts.crudfile, bundlefile)
+        return
 
-        sconn = None
-
-        for (installdir, product, status, got_version) in report:
-            if status == 'secure':
-                continue
-
-            installdir = os.path.normpath(installdir) + '/'
-
-            # is this path in our mailmap?
-            for path in mailmap.keys():
-                if not fnmatch(installdir, path + '*'):
-                    continue
-
-                # Do we have it in statedb?
-                if sconn is None:
-                    sconn = nagstate_connect(statedb)
-
-                installed_dir_sql = installdir.replace("'", "''")
-                product_name_sql  = product.name.replace("'", "''")
-                found_version_sql = got_version.replace("'", "''")
-
-                equery = """
-                    SELECT found_date, nag_date, do_not_nag_until
-                      FROM nagstate
-                     WHERE installed_dir = '""" + installed_dir_sql + """'
-                       AND product_name  = '""" + product_name_sql  + """'
-                       AND found_version = '""" + found_version_sql + "'"
-                scursor = sconn.cursor()
-                scursor.execute(equery)
-
-                row = scursor.fetchone()
-
-                isnew = 0
-
-                if not row:
-                    # this is a new discovery
-                    isnew = 1
-                    nquery = """
-                        INSERT INTO nagstate
-                                    (installed_dir, product_name, 
-                                     found_version)
-                             VALUES ('""" + installed_dir_sql + """',
-                                     '""" + product_name_sql  + """',
-                                     '""" + found_version_sql + "')"
-                    out = scursor.execute(nquery)
-                    # rerun the equery, to get the dates
-                    scursor.execute(equery)
-                    row = scursor.fetchone()
-                    
-                (found_date, nag_date, do_not_nag_until) = row
-                # do they need to be nagged?
-
-                if do_not_nag_until is not None:
-                    # we were asked not to nag them
-                    until_date = sqlite2datetime(do_not_nag_until)
-                    if now_date < until_date:
-                        if not opts.quiet:
-                            print "Not nagging about %s v.%s in %s until %s" % (
-                                    product.name, got_version, installdir,
-                                    until_date.isoformat())
-                        continue
-
-                if opts.do_not_nag_until:
-                    # we were asked to stop nagging about this issue
-                    # Sanity check on date format
-                    try:
-                        sqlite2datetime(opts.do_not_nag_until)
-                    except ValueError:
-                        print "%s is not in YYYY-MM-DD format" \
-                                % opts.do_not_nag_until
-                        sys.exit(1)
-
-                    until_sql = opts.do_not_nag_until.replace("'", "''")
-                    dnquery = """
-                        UPDATE nagstate
-                           SET do_not_nag_until = '""" + until_sql + """'
-                         WHERE installed_dir = '""" + installed_dir_sql + """'
-                           AND product_name  = '""" + product_name_sql  + """'
-                           AND found_version = '""" + found_version_sql + "'"
-                    scursor.execute(dnquery)
-                    if not opts.quiet:
-                        print "Will no longer nag about %s v.%s in %s" % (
-                                product.name, got_version, installdir)
-                    continue
-
-                nag_date   = sqlite2datetime(nag_date)
-                found_date = sqlite2datetime(found_date)
+    if opts.do_not_nag_until:
+        # Sanity check on date format
+        try:
+            sqlite2datetime(opts.do_not_nag_until)
+        except ValueError:
+            parser.error('%s is not in YYYY-MM-DD format' 
+                         % opts.do_not_nag_until)
 
-                nagdiff = now_date - nag_date
+    if opts.stats is not None or opts.promfile is not None:
+        stats.enabled = True
 
-                if not isnew and nagdiff.days < nagfreq:
-                    # they don't get nagged
-                    continue
+    shard = None
+    if opts.shard is not None:
+        try:
+            (k, n) = [int(part) for part in opts.shard.split('/')]
+        except ValueError:
+            (k, n) = (0, 0)
+        if not 1 <= k <= n:
+            parser.error('--shard must be K/N, with K between 1 and N.')
+        shard = (k, n)
+
+    crudcache = None
+    if opts.crudcache:
+        crudcache = CrudCache(opts.crudcache, opts.crudttl)
+
+    if args[0] == 'lint-signatures':
+        fixturesdir = None
+        if len(args) > 1:
+            fixturesdir = args[1]
+
+        slow = 0
+        for (product, inputname, elapsed, finished) in lint_signatures(
+                opts.crudfile, fixturesdir, crudcache=crudcache):
+            budget = product.budget or LINTBUDGET
+            if not finished:
+                print '[%s] SLOW: gave up after %.2fs on %s' % (
+                        product.name, elapsed, inputname)
+                slow += 1
+            elif elapsed > budget:
+                print '[%s] SLOW: %.2fs on %s' % (product.name, elapsed,
+                                                  inputname)
+                slow += 1
+            elif elapsed > budget / 10 and not opts.quiet:
+                print '[%s] %.2fs on %s' % (product.name, elapsed, 
+                                            inputname)
 
-                # update nag date
-                uquery = """
-                    UPDATE nagstate
-                       SET nag_date = CURRENT_DATE
-                     WHERE installed_dir = '""" + installed_dir_sql + """'
-                       AND product_name  = '""" + product_name_sql  + """'
-                       AND found_version = '""" + found_version_sql + "'"
-                scursor.execute(uquery)
-
-                founddiff = now_date - found_date
-
-                sitename = mailmap[path]['fqdn']
-
-                values = {
-                        'nagdays'         : nagdays,
-                        'daysleft'        : nagdays - founddiff.days,
-                        'sitename'        : sitename,
-                        'productname'     : product.name,
-                        'foundversion'    : got_version,
-                        'installdir'      : installdir,
-                        'secureversion'   : product.secure,
-                        'comment'         : product.comment,
-                        'infourl'         : product.infourl,
-                        'crudminerversion': VERSION
-                        }
+        if not opts.quiet:
+            print '%d regex(es) over budget' % slow
+        if slow:
+            sys.exit(1)
+
+        return
+
+    if args[0] == 'state':
+        if not opts.mailopts:
+            parser.error('The state commands need --mailopts.')
+        if len(args) < 2 or args[1] not in ('list', 'overdue', 'sites', 
+                                             'snooze'):
+            parser.error('Use "state list", "state overdue", '
+                         '"state sites" or "state snooze".')
+        if args[1] == 'snooze':
+            if len(args) < 3:
+                parser.error('You must specify the date to snooze until.')
+            try:
+                sqlite2datetime(args[2])
+            except ValueError:
+                parser.error('%s is not in YYYY-MM-DD format' % args[2])
 
-                if founddiff.days > nagdays:
-                    # past nagging deadline, don't nag them any more,
-                    # but keep nagging the hosting admins
-                    if sitename not in offenders.keys():
-                        offenders[sitename] = {
-                                'admins':    mailmap[path]['admins'],
-                                'knowndays': founddiff.days,
-                                'products':  [],
-                                }
-                    
-                else:
-                    if sitename not in naglist.keys():
-                        if not isnew:
-                            mysubject = 'Re: %s' % subject
-                        else:
-                            mysubject = subject
-
-                        naglist[sitename] = {
-                                'admins'  : mailmap[path]['admins'],
-                                'mailfrom': mailfrom,
-                                'mailcc'  : mailcc,
-                                'subject' : mysubject % values,
-                                'greeting': greeting % values,
-                                'daysleft': daysleft % values,
-                                'products': [],
-                                'closing' : closing % values
-                                }
-                           
-
-                # formulate product lines
-
-                entry = productline % values
-                entry += '\n'
-
-                if product.secure != 'none':
-                    entry += hasupdate % values
-                else:
-                    entry += noupdate % values
+        state_command(args[1:], opts.mailopts, opts.quiet)
 
-                entry += '\n'
+        return
 
-                if product.comment:
-                    entry += hascomment % values
-                    entry += '\n'
+    if args[0] == 'merge':
+        if len(args) < 2:
+            parser.error('You must specify the results files to merge.')
 
-                if product.infourl:
-                    entry += hasinfourl % values
-                    entry += '\n'
+        (index, crudsum) = load_crud(opts.crudfile, opts.env, crudcache)
+        findings = read_results(args[1:], index)
 
-                if founddiff.days > nagdays:
-                    offenders[sitename]['products'].append(entry)
-                else:
-                    naglist[sitename]['products'].append(entry)
+    elif opts.watch:
+        if (opts.csv is not None or opts.do_not_nag_until 
+                or opts.results is not None):
+            parser.error('Can not use --csv-report, --save-results or '
+                         '--do-not-nag-until with --watch.')
 
-                break
+        rootpath = os.path.abspath(args[0])
+        batches = watch_dir(rootpath, opts.crudfile, opts.quiet, opts.env,
+                            opts.jobs, opts.cachefile, opts.full, 
+                            opts.prunedirs, opts.maxdepth, crudcache,
+                            shard, opts.interval, opts.poll, opts.iothreads)
+        try:
+            for findings in batches:
+                if findings and opts.mailopts:
+                    nag_findings(findings, opts.mailopts, opts.quiet)
+                write_stats(opts.stats, opts.promfile)
+        except KeyboardInterrupt:
+            pass
 
-        if sconn is not None:
-            sconn.commit()
+        return
 
-        smtp = None
-        
-        if naglist:
-            # send the mail now
-            smtp = smtplib.SMTP(mailhost)
-            nagowners(naglist, smtp, opts.quiet)
-
-        if offenders:
-            # I know that I need to refactor this, considering
-            # nagowners is its own method.
-            if smtp is None:
-                smtp = smtplib.SMTP(mailhost)
-
-            subject   = mailini.get('nagreport', 'subject')
-            mailfrom  = mailini.get('nagreport', 'from')
-            greeting  = mailini.get('nagreport', 'greeting')
-            hostentry = mailini.get('nagreport', 'hostentry')
-            closing   = mailini.get('nagreport', 'closing')
-
-            mailto = comma2array(mailini.get('nagreport', 'to'))
-            mailcc = comma2array(mailini.get('nagreport', 'cc'))
-
-            values = {
-                    'nagdays': nagdays,
-                    'crudminerversion': VERSION
-                    }
-
-            body = greeting % values
-            body += '\n'
-
-            for sitename, offdata in offenders.items():
-                values['admins'] = COMMASPACE.join(offdata['admins'])
-                values['sitename'] = sitename
-                values['knowndays'] = offdata['knowndays']
-
-                body += hostentry % values
-                body += '\n'
-                body += '\n'.join(offdata['products'])
-        
-            body += closing % values
-            body = dotremove.sub('', body)
+    else:
+        rootpath = os.path.abspath(args[0])
+        findings = iter_analyze_dir(rootpath, opts.crudfile, opts.quiet, 
+                                    opts.env, opts.jobs, opts.cachefile, 
+                                    opts.full, opts.prunedirs, 
+                                    opts.maxdepth, crudcache, shard,
+                                    opts.iothreads)
 
-            # send mail
-            msg = MIMEText(body)
+    if opts.results is not None:
+        findings = write_results(findings, opts.results, shard)
 
-            msg['From'] = mailfrom
-            msg['Subject'] = subject
-            msg['To'] = COMMASPACE.join(mailto)
+    if opts.csv is not None:
+        findings = write_csv(findings, opts.csv, opts.repsec)
 
-            recipients = mailto
+    if opts.mailopts:
+        nag_findings(findings, opts.mailopts, opts.quiet, 
+                     opts.do_not_nag_until)
 
-            if mailcc:
-                msg['Cc'] = COMMASPACE.join(mailcc)
-                recipients.extend(mailcc)
+    # go through whatever is left, if nobody else did
+    for finding in findings:
+        pass
 
-            if not opts.quiet:
-                print 'Sending an offender report to: %s' % msg['To']
+    write_stats(opts.stats, opts.promfile)
 
-            try:
-                smtp.sendmail(mailfrom, recipients, msg.as_string())
-            except smtplib.SMTPRecipientsRefused, ex:
-                print 'Sending offender report failed: %s' % ex
+    if opts.csv is not None and not opts.quiet:
+        print 'CSV report saved in %s' % opts.csv
 
 
 if __name__ == '__main__':
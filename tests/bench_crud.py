@@ -0,0 +1,251 @@
+#!/usr/bin/python -tt
+##
+# Copyright (C) 2012 by Konstantin Ryabitsev and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+"""
+Benchmark crudminer against a synthetic hosting tree built out of the
+test fixtures. Run it from the tests/ directory, just like the tests:
+
+    python bench_crud.py --sites 500 --noise 50 -o bench.json
+
+The results are printed (or saved) as JSON, so they can be compared
+between releases.
+"""
+import os, sys
+import time
+import shutil
+import tempfile
+import random
+
+sys.path.insert(0, '../')
+
+import crudminer
+
+TESTDIR  = '.'
+CRUDFILE = '../crud.ini'
+
+def fixture_dirs(testdir):
+    """
+    Find the product fixtures to copy into the synthetic sites.
+
+    @return: list of paths to directories with one product each
+    @rtype: list
+    """
+    fixtures = []
+    for name in sorted(os.listdir(testdir)):
+        path = os.path.join(testdir, name)
+        if os.path.isdir(path):
+            fixtures.append(path)
+
+    return fixtures
+
+def make_tree(benchdir, sites, noise, depth, seed=0):
+    """
+    Build a hosting tree with the given number of sites. Every site gets
+    one of the fixtures, nested "depth" directories deep, and "noise"
+    files that don't contain anything interesting (half of them with
+    names of files we look at, like index.php).
+
+    @param benchdir: where to build the tree
+    @type  benchdir: str
+    @param sites: how many sites to make
+    @type  sites: int
+    @param noise: how many noise files to add to every site
+    @type  noise: int
+    @param depth: how deep below the site root to put the software
+    @type  depth: int
+
+    @return: how many files were created
+    @rtype: int
+    """
+    rand = random.Random(seed)
+    fixtures = fixture_dirs(TESTDIR)
+    noisenames = ('index.php', 'version.php', 'config.php', 'README')
+    filler = 'lorem ipsum dolor sit amet\n' * 40
+
+    files = 0
+    for site in range(sites):
+        siteroot = os.path.join(benchdir, 'site%05d' % site, 'www')
+        installdir = siteroot
+        for level in range(depth):
+            installdir = os.path.join(installdir, 'level%d' % level)
+
+        shutil.copytree(fixtures[site % len(fixtures)], installdir)
+        for root, dirs, filenames in os.walk(installdir):
+            files += len(filenames)
+
+        noisedir = os.path.join(siteroot, 'uploads')
+        os.makedirs(noisedir)
+        for i in range(noise):
+            if i % 2:
+                name = noisenames[rand.randint(0, len(noisenames) - 1)]
+                path = os.path.join(noisedir, 'dir%d' % i, name)
+                os.mkdir(os.path.dirname(path))
+            else:
+                path = os.path.join(noisedir, 'image%d.jpg' % i)
+            fh = open(path, 'w')
+            fh.write(filler)
+            fh.close()
+            files += 1
+
+    return files
+
+def bench_phases(rootpath, crudfile):
+    """
+    Scan the tree in this process with stats enabled, so every phase of
+    the scan is timed by the scanner itself: loading crud.ini, walking 
+    and pruning the tree, matching file paths, checking andpath files,
+    reading files, running product regexes and comparing versions.
+
+    @return: (report, phases, counters), where report is what 
+             analyze_dir returned, phases maps each phase to seconds,
+             and counters are the stats counters
+    @rtype: tuple
+    """
+    stats = crudminer.stats
+    stats.reset()
+    stats.enabled = True
+    try:
+        report = crudminer.analyze_dir(rootpath, crudfile, True)
+        snapshot = stats.snapshot()
+    finally:
+        stats.enabled = False
+        stats.reset()
+
+    phases = snapshot['timers']
+    phases['regex'] = sum([seconds for (evaluations, seconds) 
+                           in snapshot['products'].values()])
+
+    return (report, phases, snapshot['counters'])
+
+def bench_nagdb(report, statedb, phases):
+    """
+    Record every vulnerable finding in a fresh nagstate database, the
+    same way main() does, then do it again now that they are all known.
+
+    @rtype: void
+    """
+    for phase in ('nagdb_new', 'nagdb_known'):
+        started = time.time()
+        nagstate = crudminer.NagState(statedb)
+
+        for (installdir, product, status, got_version) in report:
+            if status == 'secure':
+                continue
+
+            installdir = os.path.normpath(installdir) + '/'
+            (isnew, row) = nagstate.lookup(installdir, product.name,
+                                           got_version)
+            nagstate.nag(installdir, product.name, got_version)
+
+        nagstate.save()
+        nagstate.sconn.close()
+        phases[phase] = time.time() - started
+
+def bench_csv(report, csvfile, phases):
+    """
+    Time writing the CSV report.
+
+    @rtype: void
+    """
+    started = time.time()
+    for finding in crudminer.write_csv(report, csvfile, True):
+        pass
+    phases['csv'] = time.time() - started
+
+def main():
+    from optparse import OptionParser
+
+    usage = '''usage: %prog [options]
+    Benchmark crudminer against a synthetic hosting tree.
+    '''
+
+    parser = OptionParser(usage=usage)
+    parser.add_option('--sites', dest='sites', type='int', default=200,
+        help='How many sites to put in the tree (%default).')
+    parser.add_option('--noise', dest='noise', type='int', default=20,
+        help='How many uninteresting files to add per site (%default).')
+    parser.add_option('--depth', dest='depth', type='int', default=2,
+        help='How deep to put software in each site (%default).')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=4,
+        help='Jobs to use for the parallel run (%default).')
+    parser.add_option('--crudfile', dest='crudfile', default=CRUDFILE,
+        help='Location of the crud.ini file (%default).')
+    parser.add_option('--benchdir', dest='benchdir', default=None,
+        help='Where to build the tree. It must not exist yet, and is \
+              removed afterwards (default: a temporary directory).')
+    parser.add_option('-o', '--output', dest='output', default=None,
+        help='Save the results in this file instead of printing them.')
+
+    (opts, args) = parser.parse_args()
+
+    import json
+
+    benchdir = opts.benchdir
+    if benchdir is None:
+        benchdir = tempfile.mkdtemp(prefix='crudbench-')
+    else:
+        os.makedirs(benchdir)
+
+    try:
+        rootpath = os.path.join(benchdir, 'www')
+        os.mkdir(rootpath)
+
+        started = time.time()
+        files = make_tree(rootpath, opts.sites, opts.noise, opts.depth)
+        setup = time.time() - started
+
+        (report, phases, counters) = bench_phases(rootpath, opts.crudfile)
+        bench_nagdb(report, os.path.join(benchdir, 'nagstate.sqlite'), 
+                    phases)
+        bench_csv(report, os.path.join(benchdir, 'report.csv'), phases)
+
+        totals = {}
+        for jobs in (1, opts.jobs):
+            started = time.time()
+            crudminer.analyze_dir(rootpath, opts.crudfile, True, jobs=jobs)
+            totals['analyze_dir_jobs%d' % jobs] = time.time() - started
+
+        results = {
+            'crudminer': crudminer.VERSION,
+            'python':    sys.version.split()[0],
+            'tree': {
+                'sites':  opts.sites,
+                'noise':  opts.noise,
+                'depth':  opts.depth,
+                'files':  files,
+                'setup':  setup,
+            },
+            'findings': len(report),
+            'phases':   phases,
+            'counts':   counters,
+            'totals':   totals,
+        }
+    finally:
+        shutil.rmtree(benchdir)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if opts.output is None:
+        print output
+    else:
+        fh = open(opts.output, 'w')
+        fh.write(output + '\n')
+        fh.close()
+
+if __name__ == '__main__':
+    main()
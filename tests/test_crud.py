@@ -19,6 +19,8 @@
 #
 from ConfigParser import ConfigParser, NoSectionError
 import sys
+import shutil
+import tempfile
 
 sys.path.insert(0, '../')
 
@@ -31,6 +33,20 @@ def compare_results(want, results):
     assert want in results, \
         '"%s ver %s" not found in results' % (want[0], want[3])
 
+def with_tmpdir(test):
+    """
+    Run the test with a fresh temporary directory, removed afterwards.
+    """
+    def run():
+        tmpdir = tempfile.mkdtemp()
+        try:
+            test(tmpdir)
+        finally:
+            shutil.rmtree(tmpdir)
+    run.__name__ = test.__name__
+
+    return run
+
 def check_sections(crudsec, testsecs):
     assert crudsec in testsecs, 'section "%s" not found in test.ini' % crudsec
 
@@ -63,3 +79,930 @@ def test_crud():
         # pop it from the result, so matches are faster
         results.remove(testlist)
 
+
+def test_jobs():
+    serial   = crudminer.analyze_dir(TESTDIR, CRUDFILE, True)
+    parallel = crudminer.analyze_dir(TESTDIR, CRUDFILE, True, jobs=4)
+    threaded = crudminer.analyze_dir(TESTDIR, CRUDFILE, True, iothreads=8)
+
+    assert len(serial) > 0, 'serial scan found nothing'
+
+    serial   = [(i, p.name, s, v) for (i, p, s, v) in serial]
+    parallel = [(i, p.name, s, v) for (i, p, s, v) in parallel]
+    threaded = [(i, p.name, s, v) for (i, p, s, v) in threaded]
+
+    assert serial == parallel, 'parallel scan report differs from serial'
+    assert serial == threaded, 'threaded scan report differs from serial'
+
+TESTCRUD = """
+[DEFAULT]
+env     = php
+regex   = VERSION-(\\S*)
+secure  = 1.0
+expand  = \\1
+comment =
+infourl =
+
+[Product A]
+path = /version.php
+
+[Product B]
+path = /includes/version.php
+"""
+
+def test_seekindex():
+    index = crudminer.load_seekpaths(TESTCRUD)
+
+    assert index.has_file('version.php')
+    assert not index.has_file('index.php')
+
+    assert index.match('/www/includes/version.php') == \
+        ['/version.php', '/includes/version.php']
+    assert index.match('/www/myincludes/version.php') == ['/version.php']
+    assert index.match('/www/version.php.bak') == []
+
+@with_tmpdir
+def test_cache(tmpdir):
+    import os
+
+    cachefile = os.path.join(tmpdir, 'scancache.sqlite')
+
+    results = []
+    for (jobs, iothreads, full) in ((1, 0, False), (1, 0, False), 
+                                    (4, 0, False), (1, 4, False),
+                                    (1, 0, True)):
+        report = crudminer.analyze_dir(TESTDIR, CRUDFILE, True, 
+                                       jobs=jobs, cachefile=cachefile,
+                                       full=full, iothreads=iothreads)
+        results.append([(i, p.name, s, v) for (i, p, s, v) in report])
+
+    for result in results[1:]:
+        assert result == results[0], 'cached scan report differs'
+
+@with_tmpdir
+def test_cache_8bit(tmpdir):
+    import os
+
+    # paths are bytes, and not necessarily ASCII
+    rootpath = os.path.join(tmpdir, 'caf\xc3\xa9')
+    shutil.copytree(os.path.join(TESTDIR, 'wordpress', 'fail'), 
+                    os.path.join(rootpath, 'www'))
+    cachefile = os.path.join(tmpdir, 'scancache.sqlite')
+
+    results = []
+    for run in range(2):
+        report = crudminer.analyze_dir(rootpath, CRUDFILE, True, 
+                                       cachefile=cachefile)
+        results.append([(i, p.name, s, v) for (i, p, s, v) in report])
+
+    assert results[0] == results[1], 'cached scan report differs'
+    assert results[0] and type(results[1][0][3]) is str, results
+
+@with_tmpdir
+def test_maxbytes(tmpdir):
+    import os
+
+    havepath = os.path.join(tmpdir, 'version.php')
+    fh = open(havepath, 'w')
+    fh.write(' ' * 4096 + 'VERSION-0.5\n')
+    fh.close()
+
+    index = crudminer.load_seekpaths(TESTCRUD)
+    products = index.products['/version.php']
+
+    result = crudminer.analyze_file(havepath, tmpdir, products)
+    assert result == (products[0], 'vulnerable', '0.5'), result
+
+    products[0].maxbytes = 1024
+    result = crudminer.analyze_file(havepath, tmpdir, products)
+    assert result is None, 'found version past maxbytes'
+
+@with_tmpdir
+def test_prefilter(tmpdir):
+    import os
+
+    havepath = os.path.join(tmpdir, 'version.php')
+
+    def write(contents):
+        fh = open(havepath, 'w')
+        fh.write(contents)
+        fh.close()
+
+    index = crudminer.load_seekpaths(TESTCRUD)
+    product = index.products['/version.php'][0]
+    product.sniffbytes = 1024
+    assert product.literal == 'VERSION-'
+
+    # the literal is past the sniff, so we don't read any further
+    write(' ' * 4096 + 'VERSION-0.5\n')
+    assert crudminer.read_file(havepath, [product]) == (None, [])
+
+    # a small file is read whole by the sniff
+    write('VERSION-0.5\n')
+    assert crudminer.read_file(havepath, [product]) == \
+        ('VERSION-0.5\n', [product])
+
+    write('VERSION-0.5\n' + ' ' * 4096)
+    result = crudminer.analyze_file(havepath, tmpdir, [product])
+    assert result == (product, 'vulnerable', '0.5'), result
+
+    product.minsize = 8192
+    assert crudminer.analyze_file(havepath, tmpdir, [product]) is None
+    product.minsize = 0
+    product.maxsize = 1024
+    assert crudminer.analyze_file(havepath, tmpdir, [product]) is None
+
+@with_tmpdir
+def test_andpath(tmpdir):
+    import os
+
+    crudtext = TESTCRUD + """
+[Product C]
+path    = /app/version.php
+andpath = /lib/marker.php
+regex   = VERSION-C-(\\S*)
+
+[Product D]
+path    = /app/version.php
+"""
+    index = crudminer.load_seekpaths(crudtext)
+    products = index.products['/app/version.php']
+    paths = crudminer.PathCache(index)
+    assert paths.names == set(['marker.php'])
+
+    stats = crudminer.stats
+    try:
+        for (site, marker) in (('a', True), ('b', False)):
+            os.makedirs(os.path.join(tmpdir, site, 'app'))
+            os.makedirs(os.path.join(tmpdir, site, 'lib'))
+            if marker:
+                open(os.path.join(tmpdir, site, 'lib/marker.php'), 'w')
+            fh = open(os.path.join(tmpdir, site, 'app/version.php'), 'w')
+            fh.write('VERSION-C-0.5\n')
+            fh.close()
+
+        pruner = crudminer.Pruner(tmpdir, index, paths=paths)
+        for root, dirs, files in os.walk(tmpdir):
+            pruner.prune(root, dirs, files)
+
+        stats.enabled = True
+        stats.reset()
+        for i in range(2):
+            found = crudminer.andpath_products(products, 
+                    os.path.join(tmpdir, 'a'), paths)
+            assert found == products, found
+            found = crudminer.andpath_products(products, 
+                    os.path.join(tmpdir, 'b'), paths)
+            assert [product.name for product in found] == ['Product D']
+
+        # the listings told us about a/, and we only had to ask about b/ 
+        # once
+        assert stats.snapshot()['counters']['andpath_lookups'] == 1
+
+        result = crudminer.analyze_file(
+                os.path.join(tmpdir, 'b/app/version.php'), 
+                os.path.join(tmpdir, 'b'), found)
+        assert result == (found[0], 'vulnerable', 'C-0.5'), result
+    finally:
+        stats.enabled = False
+        stats.reset()
+
+    # a cached result is not used once another product's andpath 
+    # files show up
+    crudfile = os.path.join(tmpdir, 'crud.ini')
+    fh = open(crudfile, 'w')
+    fh.write(crudtext)
+    fh.close()
+    cachefile = os.path.join(tmpdir, 'scancache.sqlite')
+
+    def scanned():
+        report = crudminer.analyze_dir(os.path.join(tmpdir, 'b'), crudfile,
+                                       True, cachefile=cachefile)
+        return [(p.name, v) for (i, p, s, v) in report 
+                if p.name != 'Product A']
+
+    assert scanned() == [('Product D', 'C-0.5')]
+    open(os.path.join(tmpdir, 'b/lib/marker.php'), 'w')
+    assert scanned() == [('Product C', '0.5')]
+    os.remove(os.path.join(tmpdir, 'b/lib/marker.php'))
+    assert scanned() == [('Product D', 'C-0.5')]
+
+def test_required_literal():
+    assert crudminer.required_literal(r"\$wp_version\s*=\s*'([^']+)'") == \
+        '$wp_version'
+    assert crudminer.required_literal(r'(?i)version\s*=\s*(\S+)') is None
+    assert crudminer.required_literal(r'.*') is None
+
+def test_version_compare():
+    less = (('1.0', '1.0.1'), ('1.9', '1.10'), ('1.0-beta2', '1.0.2'),
+            ('2.0-alpha0', '2.0-beta1'), ('1.1 RC1', '1.1.1'))
+    for (ver1, ver2) in less:
+        assert crudminer.parse_version(ver1) < crudminer.parse_version(ver2)
+
+    assert crudminer.parse_version('1.0') == crudminer.parse_version('1-0')
+    assert hash(crudminer.parse_version('1.0')) == \
+        hash(crudminer.parse_version('1-0'))
+
+    ordered = ['0.9', '1.0', '1.0.1', '1.2-rc1', '1.10']
+    keys = [crudminer.parse_version(ver) for ver in reversed(ordered)]
+    keys.sort()
+    assert [key.version for key in keys] == ordered
+
+    import pickle
+    key = crudminer.parse_version('3.0-alpha1')
+    for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+        assert pickle.loads(pickle.dumps(key, protocol)) == key
+
+    # anything else is just not equal, instead of an AttributeError
+    key = crudminer.parse_version('1.0')
+    assert not key == None and key != None
+    assert key not in [None, '1.0', 'x']
+    assert key in [None, crudminer.parse_version('1-0')]
+
+@with_tmpdir
+def test_bundle(tmpdir):
+    import os
+
+    crudfile = os.path.join(tmpdir, 'crud.ini')
+    shutil.copy(CRUDFILE, crudfile)
+
+    (index, crudsum) = crudminer.load_crud(crudfile)
+    bundlefile = crudminer.compile_bundle(crudfile)
+
+    bundle = crudminer.load_bundle(bundlefile)
+    assert bundle is not None, 'could not load the bundle'
+    assert bundle[0] == crudsum
+
+    (bindex, bcrudsum) = crudminer.load_crud(crudfile, ['php'])
+    assert bcrudsum == crudsum
+    assert sorted(bindex.byname.keys()) == sorted(index.byname.keys())
+
+    # products come out of the bundle without compiled regexes, and
+    # compile them when first used, once per pattern
+    import cPickle
+    product = bundle[1][0][1]
+    assert product._regex is None
+    product.guarded = True
+    copy = cPickle.loads(cPickle.dumps(product, 
+                                       cPickle.HIGHEST_PROTOCOL))
+    assert not copy.guarded
+    assert set(product.__slots__) - set(product._pickled) == \
+            set(['guarded', 'timed', '_regex'])
+    assert copy.regex is product.regex
+    assert copy.regex.pattern == product.pattern
+    assert (copy.name, copy.literal, copy.anchored, copy.secure_key) \
+            == (product.name, product.literal, product.anchored, 
+                product.secure_key)
+
+    # an updated crud.ini with an old mtime (e.g. from rsync -t) is 
+    # not hidden by the bundle
+    fh = open(crudfile, 'a')
+    fh.write('\n[Stale Test]\nenv = php\npath = /stale/version.php\n'
+             'regex = VERSION-(\\S*)\nsecure = 1.0\ncomment =\n'
+             'infourl =\nandpath =\nprune =\n')
+    fh.close()
+    os.utime(crudfile, (0, 0))
+    (uindex, ucrudsum) = crudminer.load_crud(crudfile)
+    assert ucrudsum != crudsum
+    assert 'Stale Test' in uindex.byname
+    crudminer.compile_bundle(crudfile)
+    (uindex, ucrudsum) = crudminer.load_crud(crudfile)
+    assert 'Stale Test' in uindex.byname
+
+    # corrupt the bundle, we should fall back to crud.ini
+    fh = open(bundlefile, 'ab')
+    fh.write('garbage')
+    fh.close()
+    assert crudminer.load_bundle(bundlefile) is None
+    (index, fcrudsum) = crudminer.load_crud(crudfile)
+    assert fcrudsum == ucrudsum
+
+def test_report():
+    import os
+
+    index = crudminer.load_seekpaths(TESTCRUD)
+    (a, b) = [index.byname[name] for name in ('Product A', 'Product B')]
+    findings = [
+        ('/www/site1/blog', a, 'vulnerable', '0.5'),
+        ('/www/site1/blog', b, 'secure', '1.0'),
+        ('/www/site2/blog', a, 'vulnerable', '0.5'),
+        ('/www//site3/./blog', b, 'vulnerable', '0.9'),
+        ('./blog', a, 'vulnerable', '0.1'),
+        ('blog', a, 'vulnerable', '0.2'),
+        ('/www/site1/blog', a, 'vulnerable', '0.5'),
+    ]
+
+    report = crudminer.Report()
+    for finding in findings:
+        report.add(*finding)
+    assert list(report) == findings
+    assert len(report) == len(findings)
+    assert report.names[0] is report.names[2]
+
+    want = [(os.path.normpath(i) + '/', p, v) 
+            for (i, p, s, v) in findings if s != 'secure']
+    assert list(report.vulnerable()) == want
+    assert list(crudminer.nag_candidates(findings)) == want
+
+    order = range(len(findings))
+    order.reverse()
+    assert list(report.reordered(order)) == findings[::-1]
+
+    unique = crudminer.Report(unique=True)
+    added = [unique.add(*finding) for finding in findings]
+    assert added == [True] * 6 + [False]
+    assert list(unique) == findings[:-1]
+
+def test_iter_analyze_dir():
+    report = crudminer.analyze_dir(TESTDIR, CRUDFILE, True)
+    report = [(i, p.name, s, v) for (i, p, s, v) in report]
+
+    for jobs in (1, 4):
+        findings = crudminer.iter_analyze_dir(TESTDIR, CRUDFILE, True, 
+                                              jobs=jobs)
+        first = findings.next()
+        streamed = [(i, p.name, s, v) for (i, p, s, v) in findings]
+        streamed.insert(0, (first[0], first[1].name, first[2], first[3]))
+
+        assert sorted(streamed) == sorted(report), \
+            'streamed findings differ with %d jobs' % jobs
+
+@with_tmpdir
+def test_prune(tmpdir):
+    import os
+
+    wordpress = os.path.join(TESTDIR, 'wordpress', 'fail')
+    for subdir in ('site', 'site/wp-content/uploads/old', 'site/.git/old',
+                   'site/cache', 'a/b/c'):
+        shutil.copytree(wordpress, os.path.join(tmpdir, subdir))
+
+    def found(**kwargs):
+        report = crudminer.analyze_dir(tmpdir, CRUDFILE, True, **kwargs)
+        return sorted([i[len(tmpdir):] for (i, p, s, v) in report
+                       if p.name == 'Wordpress'])
+
+    assert found() == ['/a/b/c', '/site', '/site/cache'], found()
+    assert found(prunedirs=['cache']) == ['/a/b/c', '/site']
+    assert found(maxdepth=3, jobs=4) == ['/site', '/site/cache']
+
+@with_tmpdir
+def test_shard(tmpdir):
+    import os
+
+    rootpath = os.path.join(tmpdir, 'www')
+    wordpress = os.path.join(TESTDIR, 'wordpress', 'fail')
+    for i in range(8):
+        shutil.copytree(wordpress, os.path.join(rootpath, 'site%d' % i))
+
+    def names(report):
+        return sorted([(i, p.name, s, v) for (i, p, s, v) in report])
+
+    everything = names(crudminer.analyze_dir(rootpath, CRUDFILE, True))
+
+    shards = []
+    resultsfiles = []
+    for k in (1, 2, 3):
+        resultsfile = os.path.join(tmpdir, 'shard%d.gz' % k)
+        findings = crudminer.iter_analyze_dir(rootpath, CRUDFILE, True,
+                                              shard=(k, 3))
+        shards.append(names(crudminer.write_results(findings, 
+                                                    resultsfile, (k, 3))))
+        resultsfiles.append(resultsfile)
+
+    assert sorted(shards[0] + shards[1] + shards[2]) == everything
+    assert len(shards[0]) and len(shards[1]) and len(shards[2])
+
+    # every finding comes out once, even if it is in several files
+    (index, crudsum) = crudminer.load_crud(CRUDFILE)
+    merged = crudminer.read_results(resultsfiles + resultsfiles[:1], 
+                                    index)
+    assert names(merged) == everything
+
+@with_tmpdir
+def test_watch(tmpdir):
+    import os
+
+    wordpress = os.path.join(TESTDIR, 'wordpress', 'fail')
+    shutil.copytree(wordpress, os.path.join(tmpdir, 'site'))
+
+    def found(report):
+        return [i[len(tmpdir):] for (i, p, s, v) in report
+                if p.name == 'Wordpress']
+
+    for poll in (True, False):
+        batches = crudminer.watch_dir(tmpdir, CRUDFILE, True, 
+                                      interval=0.1, poll=poll)
+        assert found(batches.next()) == ['/site']
+
+        for subdir in ('new/blog', 'site/wp-content/uploads/new'):
+            shutil.copytree(wordpress, os.path.join(tmpdir, subdir))
+
+        seen = set()
+        for i in range(10):
+            seen.update(found(batches.next()))
+        assert seen == set(['/new/blog']), (poll, seen)
+
+        shutil.rmtree(os.path.join(tmpdir, 'new'))
+        shutil.rmtree(os.path.join(tmpdir, 'site/wp-content/uploads/new'))
+
+@with_tmpdir
+def test_watch_fallback(tmpdir):
+    import os, errno
+
+    wordpress = os.path.join(TESTDIR, 'wordpress', 'fail')
+    shutil.copytree(wordpress, os.path.join(tmpdir, 'site'))
+
+    def found(report):
+        return [i[len(tmpdir):] for (i, p, s, v) in report
+                if p.name == 'Wordpress']
+
+    (index, crudsum) = crudminer.load_crud(CRUDFILE)
+    watcher = crudminer.InotifyWatcher(tmpdir, index, 
+                                       crudminer.Pruner(tmpdir, index))
+    watched = len(watcher.dirs)
+    watcher.close()
+
+    # run out of inotify watches while setting up, and later on
+    add_dir = crudminer.InotifyWatcher.add_dir
+    for limit in (3, watched + 2):
+        def limited_add_dir(self, path):
+            if len(self.dirs) >= limit:
+                raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+            add_dir(self, path)
+
+        crudminer.InotifyWatcher.add_dir = limited_add_dir
+        try:
+            batches = crudminer.watch_dir(tmpdir, CRUDFILE, True, 
+                                          interval=0.1)
+            assert found(batches.next()) == ['/site']
+
+            shutil.copytree(wordpress, os.path.join(tmpdir, 'new/blog'))
+
+            seen = set()
+            for i in range(10):
+                seen.update(found(batches.next()))
+            assert '/new/blog' in seen, (limit, seen)
+        finally:
+            crudminer.InotifyWatcher.add_dir = add_dir
+
+        shutil.rmtree(os.path.join(tmpdir, 'new'))
+
+@with_tmpdir
+def test_stats(tmpdir):
+    import os, json
+
+    stats = crudminer.stats
+    counted = []
+    timed = []
+    try:
+        stats.enabled = True
+        for jobs in (1, 4):
+            stats.reset()
+            crudminer.analyze_dir(TESTDIR, CRUDFILE, True, jobs=jobs)
+            snapshot = stats.snapshot()
+            timed.append(set(snapshot['timers'].keys()))
+            counted.append((snapshot['counters'], 
+                            sorted([(name, entry[0]) for (name, entry)
+                                    in snapshot['products'].items()])))
+
+        # the same work gets counted, whoever does it, except for 
+        # compiling regexes, which depends on what each process did before
+        for (counters, products) in counted:
+            counters.pop('regex_compiles', None)
+        assert counted[0] == counted[1]
+        (counters, products) = counted[0]
+        assert counters['seekfile_hits'] <= counters['files_considered']
+        assert counters['bytes_read'] > 0
+        assert dict(products)['Wordpress'] > 0
+
+        # the walk itself is only timed when it isn't spread over threads
+        phases = set(['prune', 'match', 'andpath', 'read'])
+        assert phases | set(['walk']) <= timed[0], timed[0]
+        assert phases <= timed[1], timed[1]
+
+        statsfile = os.path.join(tmpdir, 'stats.json')
+        promfile = os.path.join(tmpdir, 'crudminer.prom')
+        crudminer.write_stats(statsfile, promfile)
+        saved = json.load(open(statsfile))
+        assert saved['products']['Wordpress']['evaluations'] > 0
+        assert 'crudminer_regex_seconds{product="Wordpress"}' in \
+            open(promfile).read()
+    finally:
+        stats.enabled = False
+        stats.reset()
+
+@with_tmpdir
+def test_lint_signatures(tmpdir):
+    import os, time, re
+
+    re_flags = re.MULTILINE | re.DOTALL
+    assert crudminer.starts_with_anything('.*version = (\S+)', 
+                                          re_flags)
+    assert crudminer.starts_with_anything('.*?version = (\S+)', 
+                                          re_flags)
+    assert not crudminer.starts_with_anything('.*version', 0)
+    assert not crudminer.starts_with_anything('.+version', re_flags)
+    assert not crudminer.starts_with_anything('.*a|b', re_flags)
+
+    crudfile = os.path.join(tmpdir, 'crud.ini')
+    fh = open(crudfile, 'w')
+    fh.write('''[DEFAULT]
+env      = php
+expand   = \\1
+comment  =
+infourl  =
+andpath  =
+prune    =
+maxbytes = 0
+budget   = 0.5
+
+[Fast]
+path   = /version.php
+regex  = .*^\\s*version = '([^']+)'
+secure = 1.0
+
+[Slow]
+path   = /version.php
+regex  = version=(x+)+y
+secure = 1.0
+''')
+    fh.close()
+
+    config = ConfigParser()
+    config.read(crudfile)
+    products = dict([(name, crudminer.CrudProduct(name, config))
+                     for name in ('Fast', 'Slow')])
+    assert products['Fast'].anchored
+    assert not products['Slow'].anchored
+
+    # anchoring the search gives the same match
+    contents = "<?php\n$a = 1;\n  version = '0.9'\n"
+    assert products['Fast'].search(contents).expand('\\1') == '0.9'
+
+    started = time.time()
+    assert crudminer.guarded_search(products['Slow'], 
+                                    'version=' + 'x' * 40, 0.5) == \
+        (False, None)
+    assert time.time() - started < 5
+    assert crudminer.guarded_search(products['Fast'], contents, 5) == \
+        (True, '0.9')
+
+    linted = crudminer.lint_signatures(crudfile, size=4096)
+    (product, inputname, elapsed, finished) = linted[0]
+    assert product.name == 'Slow' and not finished
+    assert linted[1][0].name == 'Fast' and linted[1][3]
+
+    # going over budget is a warning, which -q does not hide from stderr
+    from StringIO import StringIO
+    (stdout, stderr) = (sys.stdout, sys.stderr)
+    (sys.stdout, sys.stderr) = (StringIO(), StringIO())
+    try:
+        # the first run is already stopped, and the rest are guarded
+        started = time.time()
+        assert products['Slow'].analyze(tmpdir, 'version=' + 'x' * 40) \
+                is None
+        assert time.time() - started < 5
+        assert products['Slow'].guarded
+        (out, err) = (sys.stdout.getvalue(), sys.stderr.getvalue())
+    finally:
+        (sys.stdout, sys.stderr) = (stdout, stderr)
+    assert out == '' and 'skipped' in err, (out, err)
+
+    # a regex that finished in time once runs in this process after that
+    assert products['Fast'].analyze(tmpdir, contents) == (False, '0.9')
+    assert products['Fast'].timed and not products['Fast'].guarded
+
+@with_tmpdir
+def test_nagstate(tmpdir):
+    import os
+
+    statedb = os.path.join(tmpdir, 'nagstate.sqlite')
+
+    nagstate = crudminer.NagState(statedb)
+    (isnew, row) = nagstate.lookup('/www/', 'Wordpress', '4.0')
+    assert isnew and row == [nagstate.today, nagstate.today, None]
+    (isnew, row) = nagstate.lookup('/www/', 'Wordpress', '4.0')
+    assert not isnew
+
+    nagstate.lookup('/www/', 'Mambo', '4.6.0')
+    # paths are bytes, and not necessarily ASCII
+    nagstate.lookup('/www/caf\xc3\xa9/', 'Wordpress', '4.0')
+    nagstate.nag('/www/', 'Wordpress', '4.0')
+    nagstate.snooze('/www/', 'Mambo', '4.6.0', '2030-01-01')
+    nagstate.save()
+    nagstate.sconn.close()
+
+    nagstate = crudminer.NagState(statedb)
+    assert len(nagstate.rows) == 3
+    (isnew, row) = nagstate.lookup('/www/', 'Mambo', '4.6.0')
+    assert not isnew and row[2] == '2030-01-01', row
+    (isnew, row) = nagstate.lookup('/www/caf\xc3\xa9/', 'Wordpress', '4.0')
+    assert not isnew
+
+@with_tmpdir
+def test_state(tmpdir):
+    import os
+
+    statedb = os.path.join(tmpdir, 'nagstate.sqlite')
+
+    sconn = crudminer.nagstate_connect(statedb)
+    scursor = sconn.cursor()
+    rows = [
+        ('/www/a/', 'Wordpress', '3.0', "date('now', '-60 days')", 
+         'NULL'),
+        ('/www/a/blog/', 'Mambo', '4.6.0', "date('now', '-90 days')", 
+         "date('now', '+10 days')"),
+        ('/www/b/', 'Wordpress', '3.1', "date('now', '-5 days')", 
+         'NULL'),
+        ('/other/', 'Wordpress', '3.1', "date('now', '-40 days')", 
+         "date('now', '-1 days')"),
+    ]
+    for (installdir, name, version, found, until) in rows:
+        scursor.execute("""
+            INSERT INTO nagstate (installed_dir, product_name, 
+                                  found_version, found_date, 
+                                  do_not_nag_until)
+                 VALUES (?, ?, ?, %s, %s)""" % (found, until),
+            (installdir, name, version))
+    sconn.commit()
+
+    found = crudminer.state_list(sconn, '/www/a/')
+    assert [row[0] for row in found] == ['/www/a/', '/www/a/blog/']
+    found = crudminer.state_list(sconn, None, 'Wordpress')
+    assert len(found) == 3
+
+    # the snoozed one isn't overdue, unless the snooze is over
+    found = crudminer.state_overdue(sconn, 30)
+    assert [row[0] for row in found] == ['/www/a/', '/other/'], found
+
+    mailmap = {
+        '/www/a/': {'fqdn': 'a.example.com', 'admins': []},
+        '/www/b/': {'fqdn': 'b.example.com', 'admins': []},
+    }
+    sites = crudminer.state_sites(sconn, mailmap, 30)
+    assert [site[:4] for site in sites] == [
+            (None, 1, 1, 0),
+            ('a.example.com', 2, 1, 1),
+            ('b.example.com', 1, 0, 0)], sites
+
+    assert crudminer.state_snooze(sconn, '2030-01-01', '/www/') == 3
+    assert crudminer.state_overdue(sconn, 30) == found[1:]
+    sconn.close()
+
+    # older databases get the indexes too
+    sconn = crudminer.nagstate_connect(statedb)
+    scursor = sconn.cursor()
+    for name in ('found_date', 'nag_date', 'do_not_nag_until'):
+        scursor.execute('DROP INDEX nagstate_%s' % name)
+    scursor.execute('UPDATE meta SET dbversion = 4')
+    sconn.commit()
+    sconn.close()
+
+    sconn = crudminer.nagstate_connect(statedb)
+    scursor = sconn.cursor()
+    scursor.execute("""SELECT COUNT(*) FROM sqlite_master 
+                        WHERE type = 'index' 
+                          AND name LIKE 'nagstate_%'""")
+    assert scursor.fetchone()[0] == 4
+    scursor.execute('SELECT dbversion FROM meta')
+    assert scursor.fetchone()[0] == crudminer.DBVERSION
+    sconn.close()
+
+@with_tmpdir
+def test_nag_snooze(tmpdir):
+    import os
+    from ConfigParser import RawConfigParser
+
+    statedb = os.path.join(tmpdir, 'nagstate.sqlite')
+    mailmapini = os.path.join(tmpdir, 'mailmap.ini')
+    mailopts = os.path.join(tmpdir, 'mailopts.ini')
+
+    open(mailmapini, 'w').write('[www.example.com]\n'
+                                'path = /www/\n'
+                                'email = owner@example.com\n')
+    mailini = RawConfigParser()
+    mailini.read('../mailopts.ini')
+    mailini.set('main', 'mailmap', mailmapini)
+    mailini.set('main', 'statedb', statedb)
+    mailini.write(open(mailopts, 'w'))
+
+    class Product:
+        name    = 'Wordpress'
+        secure  = '4.1'
+        comment = ''
+        infourl = ''
+
+    sent = []
+    class FakeMailer:
+        def __init__(self, *args):
+            pass
+        def sendmail(self, mailfrom, recipients, msg):
+            sent.append(recipients)
+        def flush(self, quiet):
+            return (len(sent), 0)
+
+    def snoozed_until(installdir):
+        sconn = crudminer.nagstate_connect(statedb)
+        scursor = sconn.cursor()
+        scursor.execute("""SELECT do_not_nag_until FROM nagstate
+                            WHERE installed_dir = ?""", (installdir,))
+        until = scursor.fetchone()[0]
+        sconn.close()
+        return until
+
+    mailer = crudminer.Mailer
+    crudminer.Mailer = FakeMailer
+    try:
+        # snoozing from the command line works for new findings, too
+        findings = [('/www/a', Product(), 'vulnerable', '4.0')]
+        crudminer.nag_findings(findings, mailopts, True, '2099-01-01')
+        assert sent == [] and snoozed_until('/www/a/') == '2099-01-01'
+
+        # a snooze that is over gets nagged about, and not snoozed again
+        sconn = crudminer.nagstate_connect(statedb)
+        sconn.execute("""UPDATE nagstate
+                            SET nag_date = date('now', '-10 days'),
+                                do_not_nag_until = '2020-01-01'""")
+        sconn.commit()
+        sconn.close()
+        crudminer.nag_findings(findings, mailopts, True)
+        assert len(sent) == 1 and sent[0][0] == 'owner@example.com', sent
+        assert snoozed_until('/www/a/') == '2020-01-01'
+    finally:
+        crudminer.Mailer = mailer
+
+@with_tmpdir
+def test_crudcache(tmpdir):
+    import threading
+    import BaseHTTPServer
+
+    crudtext = open(CRUDFILE).read()
+    served = {'body': crudtext, 'status': 200, 'requests': 0, 'sent': 0}
+
+    class CrudHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            served['requests'] += 1
+            etag = '"%d"' % hash(served['body'])
+            if served['status'] != 200:
+                self.send_error(served['status'])
+                return
+            if self.headers.getheader('If-None-Match') == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            served['sent'] += 1
+            self.send_response(200)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            self.wfile.write(served['body'])
+
+        def log_message(self, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), CrudHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+
+    try:
+        url = 'http://127.0.0.1:%d/crud.ini' % server.server_address[1]
+
+        # always expired, so every fetch asks the server
+        crudcache = crudminer.CrudCache(tmpdir, ttl=0)
+        assert crudcache.fetch(url) == crudtext
+        assert crudcache.fetch(url) == crudtext
+        assert (served['requests'], served['sent']) == (2, 1), served
+
+        # a fresh copy does not need the server at all
+        assert crudminer.CrudCache(tmpdir).fetch(url) == crudtext
+        assert served['requests'] == 2
+
+        # not a crud.ini, or server errors: keep the last good copy
+        served['body'] = 'this is not an ini file'
+        assert crudcache.fetch(url) == crudtext
+        served['status'] = 500
+        assert crudcache.fetch(url) == crudtext
+        assert served['requests'] == 4
+
+        (index, crudsum) = crudminer.load_crud(url, crudcache=crudcache)
+        assert index.byname
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+
+@with_tmpdir
+def test_mailer(tmpdir):
+    import os, time
+    import asyncore, smtpd, socket, threading
+
+    class CollectingServer(smtpd.SMTPServer):
+        def __init__(self):
+            smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+            self.received = []
+
+        def process_message(self, peer, mailfrom, rcpttos, data):
+            self.received.append((mailfrom, rcpttos, data))
+
+    statedb = os.path.join(tmpdir, 'nagstate.sqlite')
+    server = None
+
+    try:
+        # nobody is listening there yet
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+
+        mailhost = '127.0.0.1:%d' % port
+        sconn = crudminer.nagstate_connect(statedb)
+        mailer = crudminer.Mailer(sconn, mailhost, 1, retries=2, 
+                                  backoff=0.2)
+        for i in range(3):
+            # install dirs in the mail are bytes, not necessarily ASCII
+            mailer.sendmail('security@example.com',
+                            ['owner%d@example.com' % i],
+                            'Subject: nag %d\n\nupdate /www/caf\xc3\xa9/\n'
+                            % i)
+
+        # only the first message waits for the mail host to come back,
+        # the rest are left in the outbox without trying
+        started = time.time()
+        assert mailer.flush(True) == (0, 3)
+        assert time.time() - started < 1.2
+
+        scursor = sconn.cursor()
+        scursor.execute("SELECT attempts FROM outbox ORDER BY message_id")
+        assert [row[0] for row in scursor.fetchall()] == [1, 0, 0]
+
+        server = CollectingServer()
+        mailhost = '127.0.0.1:%d' % server.socket.getsockname()[1]
+        running = [True]
+        def serve():
+            while running[0]:
+                asyncore.loop(timeout=0.05, count=1)
+        thread = threading.Thread(target=serve)
+        thread.start()
+
+        try:
+            mailer = crudminer.Mailer(sconn, mailhost, 2)
+            assert mailer.flush(True) == (3, 0)
+        finally:
+            running[0] = False
+            thread.join()
+
+        received = sorted([(rcpttos, data) for (mailfrom, rcpttos, data) 
+                           in server.received])
+        assert [rcpttos for (rcpttos, data) in received] == [
+                ['owner0@example.com'], ['owner1@example.com'],
+                ['owner2@example.com']], received
+        assert received[0][1].endswith('/www/caf\xc3\xa9/'), received
+        scursor.execute("SELECT COUNT(*) FROM outbox")
+        assert scursor.fetchone()[0] == 0
+    finally:
+        if server is not None:
+            server.close()
+
+def test_nagtemplates():
+    from ConfigParser import RawConfigParser
+
+    mailini = RawConfigParser()
+    mailini.read('../mailopts.ini')
+    templates = crudminer.NagTemplates(mailini)
+
+    assert '\n.' not in templates.greeting
+    assert not templates.closing.startswith('.')
+
+    class Product:
+        secure  = 'none'
+        comment = ''
+        infourl = 'http://example.com/'
+
+    product = Product()
+    entry = templates.entry(product)
+    assert templates.entry(product) is entry
+    assert 'NONE AVAILABLE' in entry and 'additional info' in entry
+    assert 'comments' not in entry and entry.endswith('\n')
+
+    product.secure = '1.0'
+    entry = templates.entry(product) % {
+            'productname'  : 'Foo',
+            'installdir'   : '/var/www/',
+            'foundversion' : '0.9',
+            'secureversion': '1.0',
+            'infourl'      : 'http://example.com/'
+            }
+    assert 'secure version    : 1.0\n' in entry
+
+def test_mailmapindex():
+    mailmap = {
+            '/var/www/':          {'fqdn': 'www'},
+            '/var/www/site/':     {'fqdn': 'site'},
+            '*/tests/wordpress/': {'fqdn': 'wordpress'},
+            }
+    mailindex = crudminer.MailMapIndex(mailmap)
+
+    assert mailindex.lookup('/var/www/site/blog/') == '/var/www/site/'
+    assert mailindex.lookup('/var/www/other/') == '/var/www/'
+    assert mailindex.lookup('/var/wwwx/') is None
+    assert mailindex.lookup('/var/www/tests/wordpress/fail/') == \
+        '*/tests/wordpress/'